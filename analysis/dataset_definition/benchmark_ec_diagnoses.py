@@ -0,0 +1,169 @@
+# Benchmark of multi-column diagnosis matching for emergency_care_attendances
+#
+# Generates an emergency care attendances table with 24 diagnosis columns in a local SQLite
+# database and times "first matching attendance in a window" for each way of writing the
+# codelist match:
+#   nested        - 24 is_in conditions folded left to right, ((d01 OR d02) OR d03) OR ...
+#   balanced      - the same conditions as a balanced tree, as built by any_of
+#   unpivot_view  - a UNION ALL view with one row per (attendance, diagnosis) and a single IN
+#   unpivot_table - the same rows materialised into an indexed table (build time reported separately)
+#
+# Run from the repository root, e.g.:
+#   python analysis/dataset_definition/benchmark_ec_diagnoses.py --rows 500000
+
+import csv
+import json
+import operator
+import random
+import sqlite3
+import time
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from functools import reduce
+
+ec_diagnosis_columns = [f"diagnosis_{i:02d}" for i in range(1, 25)]
+
+# Data ----------------------------------------------------------------------------------------------
+
+def read_codelist(filename, column):
+    with open(filename, newline="") as f:
+        return sorted({row[column] for row in csv.DictReader(f) if row[column]})
+
+def generate_attendances(rows, patients, codelist, match_rate, seed):
+    # Most attendances record one to three diagnoses and leave the remaining columns empty
+    rng = random.Random(seed)
+    start = date(2018, 1, 1)
+    other_codes = [str(rng.randrange(10**8, 10**9)) for _ in range(5000)]
+    for attendance_id in range(rows):
+        n_diagnoses = min(24, max(1, int(rng.expovariate(0.6)) + 1))
+        diagnoses = [
+            rng.choice(codelist) if rng.random() < match_rate else rng.choice(other_codes)
+            for _ in range(n_diagnoses)
+        ]
+        yield (
+            attendance_id,
+            rng.randrange(patients),
+            (start + timedelta(days=rng.randrange(6 * 365))).isoformat(),
+            *diagnoses,
+            *[None] * (24 - n_diagnoses),
+        )
+
+def create_database(rows, patients, codelist, match_rate, seed):
+    conn = sqlite3.connect(":memory:")
+    columns = ", ".join(f"{column} TEXT" for column in ec_diagnosis_columns)
+    conn.execute(
+        f"CREATE TABLE emergency_care_attendances "
+        f"(attendance_id INTEGER, patient_id INTEGER, arrival_date TEXT, {columns})"
+    )
+    conn.executemany(
+        f"INSERT INTO emergency_care_attendances VALUES ({', '.join(['?'] * 27)})",
+        generate_attendances(rows, patients, codelist, match_rate, seed),
+    )
+    conn.execute("CREATE TABLE codelist (code TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO codelist VALUES (?)", [(code,) for code in codelist])
+    conn.execute(
+        "CREATE VIEW ec_diagnoses AS "
+        + " UNION ALL ".join(
+            f"SELECT attendance_id, patient_id, arrival_date, {column} AS code "
+            f"FROM emergency_care_attendances WHERE {column} IS NOT NULL"
+            for column in ec_diagnosis_columns
+        )
+    )
+    conn.commit()
+    return conn
+
+# Queries -------------------------------------------------------------------------------------------
+
+def nested_or(conditions):
+    return reduce(lambda a, b: f"({a} OR {b})", conditions)
+
+def balanced_or(conditions):
+    conditions = list(conditions)
+    while len(conditions) > 1:
+        conditions = [reduce(lambda a, b: f"({a} OR {b})", conditions[i:i + 2]) for i in range(0, len(conditions), 2)]
+    return conditions[0]
+
+def build_queries():
+    conditions = [f"{column} IN (SELECT code FROM codelist)" for column in ec_diagnosis_columns]
+    window = "arrival_date BETWEEN :start_date AND :end_date"
+    wide = (
+        "SELECT patient_id, MIN(arrival_date) FROM emergency_care_attendances "
+        "WHERE {predicate} AND " + window + " GROUP BY patient_id"
+    )
+    long = (
+        "SELECT patient_id, MIN(arrival_date) FROM {source} "
+        "WHERE code IN (SELECT code FROM codelist) AND " + window + " GROUP BY patient_id"
+    )
+    return {
+        "nested": wide.format(predicate=nested_or(conditions)),
+        "balanced": wide.format(predicate=balanced_or(conditions)),
+        "unpivot_view": long.format(source="ec_diagnoses"),
+        "unpivot_table": long.format(source="ec_diagnoses_table"),
+    }
+
+def build_unpivot_table(conn):
+    start = time.perf_counter()
+    conn.execute("CREATE TABLE ec_diagnoses_table AS SELECT * FROM ec_diagnoses")
+    conn.execute("CREATE INDEX ec_diagnoses_table_code ON ec_diagnoses_table (code)")
+    conn.commit()
+    return time.perf_counter() - start
+
+def time_query(conn, sql, params, repeats):
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = sorted(conn.execute(sql, params).fetchall())
+        runs.append(time.perf_counter() - start)
+    return min(runs), result
+
+# Main ----------------------------------------------------------------------------------------------
+
+def main():
+    parser = ArgumentParser(description="Benchmark multi-column diagnosis matching on a generated emergency care table")
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--patients", type=int, default=200000)
+    parser.add_argument("--codelist", default="codelists/bristol-parkinsons-disease-snomed-ct-v13.csv")
+    parser.add_argument("--column", default="code")
+    parser.add_argument("--match-rate", type=float, default=0.005)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="optional JSON file for the timings")
+    args = parser.parse_args()
+
+    codelist = read_codelist(args.codelist, args.column)
+    start = time.perf_counter()
+    conn = create_database(args.rows, args.patients, codelist, args.match_rate, args.seed)
+    print(f"Generated {args.rows} attendances for {args.patients} patients in {time.perf_counter() - start:.1f} s")
+    print(f"Codelist {args.codelist}: {len(codelist)} codes")
+    build_seconds = build_unpivot_table(conn)
+
+    params = {"start_date": "2020-01-01", "end_date": "2024-12-31"}
+    timings = {}
+    results = {}
+    for form, sql in build_queries().items():
+        timings[form], results[form] = time_query(conn, sql, params, args.repeats)
+
+    reference = results["nested"]
+    print(f"\nFirst matching attendance per patient (best of {args.repeats}):")
+    for form, seconds in timings.items():
+        same = "same" if results[form] == reference else "DIFFERENT"
+        print(f"  {form:<14} {seconds * 1000:9.1f} ms  {len(results[form])} patients ({same} as nested)")
+    print(f"  unpivot_table build {build_seconds * 1000:9.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "rows": args.rows,
+                    "patients": args.patients,
+                    "codelist_size": len(codelist),
+                    "timings_ms": {form: seconds * 1000 for form, seconds in timings.items()},
+                    "unpivot_table_build_ms": build_seconds * 1000,
+                    "results_match": all(result == reference for result in results.values()),
+                },
+                f,
+                indent=2,
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# Per-variable extraction benchmark
+#
+# Extracts each variable of a dataset definition, or each section of variables (inclusion, exposures,
+# QA, outcomes, strata, covariates, subgroups, ...; see variable_roles in variables_manifest.py), on
+# its own against a fixed local database from local_backend.py, and records the wall time, the peak
+# memory of the ehrQL process and the size of the SQL that ehrQL generates for it. The population and
+# index dates are always extracted, so a run with no variables ("base") is timed first and each unit
+# is also reported net of it.
+#
+# Each unit is run through a generated wrapper definition that runs the definition as usual and then
+# keeps only the unit's variables, so the definitions need no changes. The report is ranked by time
+# and, with --baseline, compared with a previous report: a unit that is slower than its baseline by
+# more than --tolerance (and by at least --min-seconds) is a regression, and the script exits with 1.
+#
+# Run from the repository root, with a database built by generate_synthetic_data.py and
+# local_backend.py load (with a fixed --seed, so the data is the same between runs), e.g.:
+#   python analysis/dataset_definition/benchmark_variables.py dataset_definition_prevax.py \
+#     --database local_tpp.db --by section --output benchmark_prevax.json -- --inline-dates
+#   python analysis/dataset_definition/benchmark_variables.py dataset_definition_prevax.py \
+#     --database local_tpp.db --by variable --baseline benchmark_prevax.json --output benchmark_new.json -- --inline-dates
+# A CSV copy of the report is written next to the JSON file.
+
+import csv
+import json
+import os
+import runpy
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from local_backend import DEFINITION_DIR
+from variables_manifest import dataset_variables, variable_role
+
+WRAPPER = """\
+# Generated by benchmark_variables.py: {definition} with only the variables in BENCHMARK_VARIABLES
+import json
+import os
+import runpy
+import sys
+
+sys.path.insert(0, {definition_dir!r})
+from variables_manifest import dataset_variables
+
+dataset = runpy.run_path({definition_path!r})["dataset"]
+variables = dataset_variables(dataset)
+keep = set(json.loads(os.environ["BENCHMARK_VARIABLES"]))
+for name in list(variables):
+    if name not in keep:
+        del variables[name]
+"""
+
+def write_wrapper(definition, directory):
+    wrapper = os.path.join(directory, f"benchmark_{definition}")
+    with open(wrapper, "w") as f:
+        f.write(WRAPPER.format(
+            definition=definition,
+            definition_dir=os.path.abspath(DEFINITION_DIR),
+            definition_path=os.path.abspath(os.path.join(DEFINITION_DIR, definition)),
+        ))
+    return wrapper
+
+# Columns added to every cohort dataset whatever is selected, so they are part of the base run
+base_variables = ["index_date", "end_date_exposure", "end_date_outcome"]
+
+# Units -----------------------------------------------------------------------------------------
+
+def load_definition_variables(definition, user_args):
+    # Load the definition as ehrQL would, and take the variables it adds
+    sys.path.insert(0, DEFINITION_DIR)
+    sys.argv = [definition, *user_args]
+    namespace = runpy.run_path(os.path.join(DEFINITION_DIR, definition))
+    return list(dataset_variables(namespace["dataset"]))
+
+def benchmark_units(variable_names, by):
+    names = [name for name in variable_names if name not in base_variables]
+    if by == "variable":
+        return {name: [name] for name in names}
+    sections = {}
+    for name in names:
+        sections.setdefault(variable_role(name), []).append(name)
+    return sections
+
+# Runs ------------------------------------------------------------------------------------------
+
+def measure(command, env):
+    # Wait for the process with os.wait4, which also gives its peak resident memory; the log goes to a
+    # file so that the process cannot block on a full pipe
+    with tempfile.TemporaryFile() as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=log)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        # Popen did not reap the process itself, so record its exit code on it
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            log.seek(0)
+            sys.stderr.write(log.read().decode())
+            sys.exit(f"ehrQL failed: {shlex.join(command)}")
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, usage.ru_maxrss / 1024
+
+def generated_sql(command, env):
+    result = subprocess.run(command, env=env, capture_output=True)
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr.decode())
+        sys.exit(f"ehrQL failed: {shlex.join(command)}")
+    return result.stdout
+
+def run_unit(wrapper, variables, database, user_args, ehrql="ehrql", repeats=1):
+    env = dict(os.environ, BENCHMARK_VARIABLES=json.dumps(variables))
+    database_args = ["--dsn", f"sqlite:///{os.path.abspath(database)}", "--query-engine", "sqlite"]
+    definition_args = ["--", *user_args] if user_args else []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = []
+        for _ in range(repeats):
+            command = [
+                *shlex.split(ehrql), "generate-dataset", wrapper,
+                "--output", os.path.join(tmp, "output.csv"), *database_args, *definition_args,
+            ]
+            runs.append(measure(command, env))
+        seconds, peak_memory = min(runs)
+
+    sql = generated_sql(
+        [*shlex.split(ehrql), "dump-dataset-sql", wrapper, "--query-engine", "sqlite", *definition_args], env
+    )
+    return dict(seconds=seconds, peak_memory_mb=peak_memory, sql_bytes=len(sql))
+
+# Report ----------------------------------------------------------------------------------------
+
+def rank(results):
+    return sorted(results, key=lambda result: result["seconds"], reverse=True)
+
+def compare(results, baseline, tolerance, min_seconds):
+    previous = {result["unit"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["unit"])
+        if before is None:
+            result["baseline_seconds"] = None
+            continue
+        result["baseline_seconds"] = before["seconds"]
+        slower = result["seconds"] - before["seconds"]
+        if slower > min_seconds and result["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(result["unit"])
+    return regressions
+
+report_columns = [
+    "unit", "variables", "seconds", "net_seconds", "peak_memory_mb", "sql_bytes", "baseline_seconds",
+]
+
+def write_report(report, output):
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    with open(os.path.splitext(output)[0] + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=report_columns, extrasaction="ignore")
+        writer.writeheader()
+        for result in report["results"]:
+            writer.writerow(dict(result, variables=" ".join(result["variables"])))
+
+def print_report(report, regressions):
+    base = report["base"]
+    print(f"\nbase: {base['seconds']:.2f} s, {base['peak_memory_mb']:.0f} MB, {base['sql_bytes']:,} bytes of SQL")
+    print(f"{'unit':<40} {'seconds':>8} {'net':>8} {'MB':>7} {'SQL bytes':>10} {'baseline':>9}")
+    for result in report["results"]:
+        baseline = result.get("baseline_seconds")
+        print(
+            f"{result['unit']:<40} {result['seconds']:8.2f} {result['net_seconds']:8.2f} "
+            f"{result['peak_memory_mb']:7.0f} {result['sql_bytes']:10,} "
+            f"{'' if baseline is None else f'{baseline:9.2f}'}"
+            f"{'  REGRESSION' if result['unit'] in regressions else ''}"
+        )
+
+# Main ------------------------------------------------------------------------------------------
+
+def main():
+    parser = ArgumentParser(description="Time the extraction of each variable or section of a dataset definition")
+    parser.add_argument("definition", help=f"dataset definition in {DEFINITION_DIR}")
+    parser.add_argument("--database", required=True, help="SQLite database from local_backend.py load")
+    parser.add_argument("--by", choices=["variable", "section"], default="section")
+    parser.add_argument("--units", nargs="+", help="only benchmark these variables or sections")
+    parser.add_argument("--repeats", type=int, default=1, help="report the fastest of this many runs")
+    parser.add_argument("--ehrql", default="ehrql", help="command that runs ehrQL")
+    parser.add_argument("--output", required=True, help="JSON report (and a CSV copy)")
+    parser.add_argument("--baseline", help="previous JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown as a fraction of the baseline")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="ignore slowdowns smaller than this")
+    parser.add_argument("user_args", nargs="*", help="arguments of the dataset definition (after --)")
+    args = parser.parse_args()
+
+    units = benchmark_units(load_definition_variables(args.definition, args.user_args), args.by)
+    if args.units:
+        units = {unit: variables for unit, variables in units.items() if unit in args.units}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        wrapper = write_wrapper(args.definition, tmp)
+        base = run_unit(wrapper, [], args.database, args.user_args, args.ehrql, args.repeats)
+        results = []
+        for i, (unit, variables) in enumerate(units.items()):
+            result = run_unit(wrapper, variables, args.database, args.user_args, args.ehrql, args.repeats)
+            result.update(unit=unit, variables=variables, net_seconds=result["seconds"] - base["seconds"])
+            results.append(result)
+            print(f"  [{i + 1}/{len(units)}] {unit:<40} {result['seconds']:8.2f} s")
+
+    report = dict(
+        definition=args.definition,
+        user_args=args.user_args,
+        database=args.database,
+        database_bytes=os.path.getsize(args.database),
+        by=args.by,
+        repeats=args.repeats,
+        base=base,
+        results=rank(results),
+    )
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("database_bytes") != report["database_bytes"]:
+            print(f"Warning: the baseline was run against a different database ({baseline.get('database')})")
+        regressions = compare(report["results"], baseline, args.tolerance, args.min_seconds)
+        report["regressions"] = regressions
+
+    write_report(report, args.output)
+    print_report(report, regressions)
+    print(f"Wrote {args.output}")
+    if regressions:
+        sys.exit(f"{len(regressions)} regressions against {args.baseline}: {', '.join(regressions)}")
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,85 @@
 # Setup
+import time
+
 from ehrql import codelist_from_csv
 
+# Codelists are registered here and only parsed the first time they are imported, e.g.
+# from codelists import ast_primis, shield_primis
+# so each dataset definition only pays for the codelists it uses. import_report() lists what was loaded
+# (the cohort definitions write it to stderr with --codelist-report)
+
+_registry = {}
+_groups = {}
+_sources = {}
+_load_times = {}
+
+def register_codelist(name, filename, column, category_column=None):
+    _sources[name] = filename
+    _registry[name] = lambda: codelist_from_csv(filename, column=column, category_column=category_column)
+
+# A dictionary of registered codelists, keyed by category
+def register_codelist_group(name, **codelists):
+    _groups[name] = list(codelists.values())
+    _registry[name] = lambda: {category: _load(codelist) for category, codelist in codelists.items()}
+
+def _load(name):
+    if name not in _load_times:
+        start = time.perf_counter()
+        globals()[name] = _registry[name]()
+        _load_times[name] = time.perf_counter() - start
+    return globals()[name]
+
+def __getattr__(name):
+    if name in _registry:
+        return _load(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(_registry))
+
+def load_all():
+    for name in _registry:
+        _load(name)
+
+# The codelists loaded so far, with the CSV file each was read from (used by variables_manifest.py)
+def loaded_codelists():
+    return {name: (_sources[name], globals()[name]) for name in _load_times if name not in _groups}
+
+# The names of the codelists in a group (used by generate_synthetic_data.py)
+def group_members(name):
+    return _groups[name]
+
+def import_report():
+    # A group's load time includes its members, so only count the member codelists in the total
+    total = sum(seconds for name, seconds in _load_times.items() if name not in _groups)
+    lines = [f"Codelists: {len(_load_times)} of {len(_registry)} loaded in {total * 1000:.1f} ms"]
+    for name, seconds in _load_times.items():
+        lines.append(f"  {name:<35} {seconds * 1000:7.1f} ms")
+    return "\n".join(lines)
+
 
 ###########################
 #       Exposure(s)       #
 ###########################
 
 # Covid
-covid_codes = codelist_from_csv(
+register_codelist(
+  "covid_codes",
   "codelists/user-RochelleKnight-confirmed-hospitalised-covid-19.csv",
   column = "code"
 )
-covid_primary_care_positive_test = codelist_from_csv(
+register_codelist(
+  "covid_primary_care_positive_test",
   "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
   column = "CTV3ID"
 )
-covid_primary_care_code = codelist_from_csv(
+register_codelist(
+  "covid_primary_care_code",
   "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
   column = "CTV3ID"
 )
-covid_primary_care_sequalae = codelist_from_csv(
+register_codelist(
+  "covid_primary_care_sequalae",
   "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
   column = "CTV3ID"
 )
@@ -29,62 +89,73 @@ covid_primary_care_sequalae = codelist_from_csv(
 ###########################
 
 # Ethnicity
-ethnicity_snomed = codelist_from_csv(
+register_codelist(
+  "ethnicity_snomed",
   "codelists/opensafely-ethnicity-snomed-0removed.csv",
   column = "code",
   category_column = "Grouping_6"
 )
 
 # Smoking
-smoking_clear = codelist_from_csv(
+register_codelist(
+  "smoking_clear",
   "codelists/opensafely-smoking-clear.csv",
   column = "CTV3Code",
   category_column = "Category"
 )
-smoking_unclear = codelist_from_csv(
+register_codelist(
+  "smoking_unclear",
   "codelists/opensafely-smoking-unclear.csv",
   column = "CTV3Code",
   category_column = "Category"
 )
-ever_current_smoke = codelist_from_csv(
+register_codelist(
+  "ever_current_smoke",
   "codelists/bristol-smoke-and-eversmoke.csv",
   column = "code"
 )
 
 # BMI
-bmi_obesity_snomed = codelist_from_csv(
+register_codelist(
+  "bmi_obesity_snomed",
   "codelists/user-elsie_horne-bmi_obesity_snomed.csv",
   column = "code"
 )
-bmi_obesity_icd10 = codelist_from_csv(
+register_codelist(
+  "bmi_obesity_icd10",
   "codelists/user-elsie_horne-bmi_obesity_icd10.csv",
   column = "code"
 )
-bmi_primis = codelist_from_csv(
+register_codelist(
+  "bmi_primis",
   "codelists/primis-covid19-vacc-uptake-bmi.csv",
   column = "code"
 )
 
 # Wider Learning Disability
-learndis_primis = codelist_from_csv(
+register_codelist(
+  "learndis_primis",
   "codelists/primis-covid19-vacc-uptake-learndis.csv",
   column = "code"
 )
 
 # Patients in long-stay nursing and residential care
-longres_primis = codelist_from_csv(
+register_codelist(
+  "longres_primis",
   "codelists/primis-covid19-vacc-uptake-longres.csv",
   column = "code"
 )
 
 # High Risk from COVID-19 code
-shield_primis = codelist_from_csv(
+register_codelist(
+  "shield_primis",
   "codelists/primis-covid19-vacc-uptake-shield.csv",
   column = "code"
 )
 
 # Lower Risk from COVID-19 codes
-nonshield_primis = codelist_from_csv(
+register_codelist(
+  "nonshield_primis",
   "codelists/primis-covid19-vacc-uptake-nonshield.csv",
   column = "code"
 )
@@ -92,251 +163,336 @@ nonshield_primis = codelist_from_csv(
 # For JCVI groups
 
 ## Pregnancy codes
-preg_primis = codelist_from_csv(
+register_codelist(
+  "preg_primis",
   "codelists/primis-covid19-vacc-uptake-preg.csv",
   column = "code"
 )
 
 ## Pregnancy or Delivery codes
-pregdel_primis = codelist_from_csv(
+register_codelist(
+  "pregdel_primis",
   "codelists/primis-covid19-vacc-uptake-pregdel.csv",
   column = "code"
 )
 
 ## All BMI coded terms
-bmi_stage_primis = codelist_from_csv(
+register_codelist(
+  "bmi_stage_primis",
   "codelists/primis-covid19-vacc-uptake-bmi_stage.csv",
   column = "code"
 )
 
 ## Severe Obesity code recorded
-sev_obesity_primis = codelist_from_csv(
+register_codelist(
+  "sev_obesity_primis",
   "codelists/primis-covid19-vacc-uptake-sev_obesity.csv",
   column = "code"
 )
 
 ## Asthma Diagnosis code
-ast_primis = codelist_from_csv(
+register_codelist(
+  "ast_primis",
   "codelists/primis-covid19-vacc-uptake-ast.csv",
   column = "code"
 )
 
 ## Asthma Admission codes
-astadm_primis = codelist_from_csv(
+register_codelist(
+  "astadm_primis",
   "codelists/primis-covid19-vacc-uptake-astadm.csv",
   column = "code"
 )
 
 ## Asthma systemic steroid prescription codes
-astrx_primis = codelist_from_csv(
+register_codelist(
+  "astrx_primis",
   "codelists/primis-covid19-vacc-uptake-astrx.csv",
   column = "code"
 )
 
 ## Chronic Respiratory Disease
-resp_primis = codelist_from_csv(
+register_codelist(
+  "resp_primis",
   "codelists/primis-covid19-vacc-uptake-resp_cov.csv",
   column = "code"
 )
 
 ## Chronic Neurological Disease including Significant Learning Disorder
-cns_primis = codelist_from_csv(
+register_codelist(
+  "cns_primis",
   "codelists/primis-covid19-vacc-uptake-cns_cov.csv",
   column = "code"
 )
 
 ## Asplenia or Dysfunction of the Spleen codes
-spln_primis = codelist_from_csv(
+register_codelist(
+  "spln_primis",
   "codelists/primis-covid19-vacc-uptake-spln_cov.csv",
   column = "code"
 )
 
 ## Diabetes diagnosis codes
-diab_primis = codelist_from_csv(
+register_codelist(
+  "diab_primis",
   "codelists/primis-covid19-vacc-uptake-diab.csv",
   column = "code"
 )
 
 ## Diabetes resolved codes
-dmres_primis = codelist_from_csv(
+register_codelist(
+  "dmres_primis",
   "codelists/primis-covid19-vacc-uptake-dmres.csv",
   column = "code"
 )
 
 ## Severe Mental Illness codes
-sev_mental_primis = codelist_from_csv(
+register_codelist(
+  "sev_mental_primis",
   "codelists/primis-covid19-vacc-uptake-sev_mental.csv",
   column = "code"
 )
 
 ## Remission codes relating to Severe Mental Illness
-smhres_primis = codelist_from_csv(
+register_codelist(
+  "smhres_primis",
   "codelists/primis-covid19-vacc-uptake-smhres.csv",
   column = "code"
 )
 
 ## Chronic heart disease codes
-chd_primis = codelist_from_csv(
+register_codelist(
+  "chd_primis",
   "codelists/primis-covid19-vacc-uptake-chd_cov.csv",
   column = "code"
 )
 
 ## Chronic kidney disease diagnostic codes
-ckd_primis = codelist_from_csv(
+register_codelist(
+  "ckd_primis",
   "codelists/primis-covid19-vacc-uptake-ckd_cov.csv",
   column = "code"
 )
 
 ## Chronic kidney disease codes - all stages
-ckd15_primis = codelist_from_csv(
+register_codelist(
+  "ckd15_primis",
   "codelists/primis-covid19-vacc-uptake-ckd15.csv",
   column = "code"
 )
 
 ## Chronic kidney disease codes-stages 3 - 5
-ckd35_primis = codelist_from_csv(
+register_codelist(
+  "ckd35_primis",
   "codelists/primis-covid19-vacc-uptake-ckd35.csv",
   column = "code"
 )
 
 ## Chronic Liver disease codes
-cld_primis = codelist_from_csv(
+register_codelist(
+  "cld_primis",
   "codelists/primis-covid19-vacc-uptake-cld.csv",
   column = "code"
 )
 
 ## Immunosuppression diagnosis codes
-immdx_primis = codelist_from_csv(
+register_codelist(
+  "immdx_primis",
   "codelists/primis-covid19-vacc-uptake-immdx_cov.csv",
   column = "code"
 )
 
 ## Immunosuppression medication codes
-immrx_primis = codelist_from_csv(
+register_codelist(
+  "immrx_primis",
   "codelists/primis-covid19-vacc-uptake-immrx.csv",
   column = "code"
 )
 
+## PRIMIS codelists by category, for deriving the JCVI groups
+register_codelist_group(
+  "jcvi_cev_primis",
+  shield = "shield_primis",
+  nonshield = "nonshield_primis",
+  preg = "preg_primis",
+  pregdel = "pregdel_primis",
+)
+
+register_codelist_group(
+  "jcvi_ar_primis",
+  ast = "ast_primis",
+  astadm = "astadm_primis",
+  resp = "resp_primis",
+  cns = "cns_primis",
+  diab = "diab_primis",
+  dmres = "dmres_primis",
+  sev_mental = "sev_mental_primis",
+  smhres = "smhres_primis",
+  chd = "chd_primis",
+  ckd = "ckd_primis",
+  ckd15 = "ckd15_primis",
+  ckd35 = "ckd35_primis",
+  cld = "cld_primis",
+  immdx = "immdx_primis",
+  spln = "spln_primis",
+  learndis = "learndis_primis",
+  bmi_stage = "bmi_stage_primis",
+  sev_obesity = "sev_obesity_primis",
+  bmi = "bmi_primis",
+)
+
+register_codelist_group(
+  "jcvi_ar_primis_dmd",
+  astrx = "astrx_primis",
+  immrx = "immrx_primis",
+)
+
 # Stroke Ischaemic (Ischaemic Stroke)
-stroke_isch_snomed = codelist_from_csv(
+register_codelist(
+  "stroke_isch_snomed",
   "codelists/user-elsie_horne-stroke_isch_snomed.csv",
   column = "code"
 )
-stroke_isch_icd10 = codelist_from_csv(
+register_codelist(
+  "stroke_isch_icd10",
   "codelists/user-RochelleKnight-stroke_isch_icd10.csv",
   column = "code"
 )
 
 # Liver disease
-liver_disease_snomed = codelist_from_csv(
+register_codelist(
+  "liver_disease_snomed",
   "codelists/user-elsie_horne-liver_disease_snomed.csv",
   column = "code"
 )
-liver_disease_icd10 = codelist_from_csv(
+register_codelist(
+  "liver_disease_icd10",
   "codelists/user-elsie_horne-liver_disease_icd10.csv",
   column = "code"
 )
 
 # COPD
-copd_ctv3 = codelist_from_csv(
+register_codelist(
+  "copd_ctv3",
   "codelists/opensafely-current-copd.csv",
   column = "CTV3ID"
 )
-copd_icd10 = codelist_from_csv(
+register_codelist(
+  "copd_icd10",
   "codelists/user-elsie_horne-copd_icd10.csv",
   column = "code"
 )
 
 # Chronic Kidney Disease (CKD)
-ckd_snomed = codelist_from_csv(
+register_codelist(
+  "ckd_snomed",
   "codelists/user-elsie_horne-ckd_snomed.csv",
   column = "code"
 )
-ckd_icd10 = codelist_from_csv(
+register_codelist(
+  "ckd_icd10",
   "codelists/user-elsie_horne-ckd_icd10.csv",
   column = "code"
 )
 
 # Cancer
-cancer_snomed = codelist_from_csv(
+register_codelist(
+  "cancer_snomed",
   "codelists/user-elsie_horne-cancer_snomed.csv",
   column = "code"
 )
-cancer_icd10 = codelist_from_csv(
+register_codelist(
+  "cancer_icd10",
   "codelists/user-elsie_horne-cancer_icd10.csv",
   column = "code"
 )
 
 # Hypertension
-hypertension_icd10 = codelist_from_csv(
+register_codelist(
+  "hypertension_icd10",
   "codelists/user-elsie_horne-hypertension_icd10.csv",
   column = "code"
 )
-hypertension_drugs_dmd = codelist_from_csv(
+register_codelist(
+  "hypertension_drugs_dmd",
   "codelists/user-elsie_horne-hypertension_drugs_dmd.csv",
   column = "dmd_id"
 )
-hypertension_snomed = codelist_from_csv(
+register_codelist(
+  "hypertension_snomed",
   "codelists/nhsd-primary-care-domain-refsets-hyp_cod.csv",
   column = "code"
 )
 
 # Diabetes
-diabetes_icd10 = codelist_from_csv(
+register_codelist(
+  "diabetes_icd10",
   "codelists/user-elsie_horne-diabetes_icd10.csv",
   column = "code"
 )
-diabetes_drugs_dmd = codelist_from_csv(
+register_codelist(
+  "diabetes_drugs_dmd",
   "codelists/user-elsie_horne-diabetes_drugs_dmd.csv",
   column = "dmd_id"
 )
-diabetes_snomed = codelist_from_csv(
+register_codelist(
+  "diabetes_snomed",
   "codelists/user-elsie_horne-diabetes_snomed.csv",
   column = "code"
 )
 
 # Depression
-depression_snomed = codelist_from_csv(
+register_codelist(
+  "depression_snomed",
   "codelists/user-hjforbes-depression-symptoms-and-diagnoses.csv",
   column = "code"
 )
-depression_icd10 = codelist_from_csv(
+register_codelist(
+  "depression_icd10",
   "codelists/user-kurttaylor-depression_icd10.csv",
   column = "code"
 )
 
 # AMI (Acute Myocardial Infarction)
-ami_snomed = codelist_from_csv(
+register_codelist(
+  "ami_snomed",
   "codelists/user-elsie_horne-ami_snomed.csv",
   column = "code"
 )
-ami_icd10 = codelist_from_csv(
+register_codelist(
+  "ami_icd10",
   "codelists/user-RochelleKnight-ami_icd10.csv",
   column = "code"
 )
-ami_prior_icd10 = codelist_from_csv(
+register_codelist(
+  "ami_prior_icd10",
   "codelists/user-elsie_horne-ami_prior_icd10.csv",
   column = "code"
 )
 
 #Quality assurance codes
-prostate_cancer_snomed = codelist_from_csv(
+register_codelist(
+  "prostate_cancer_snomed",
   "codelists/user-RochelleKnight-prostate_cancer_snomed.csv",
   column = "code"
 )
-prostate_cancer_icd10 = codelist_from_csv(
+register_codelist(
+  "prostate_cancer_icd10",
   "codelists/user-RochelleKnight-prostate_cancer_icd10.csv",
   column = "code"
 )
-pregnancy_snomed = codelist_from_csv(
+register_codelist(
+  "pregnancy_snomed",
   "codelists/user-RochelleKnight-pregnancy_and_birth_snomed.csv",
   column = "code"
 )
-cocp_dmd = codelist_from_csv(
+register_codelist(
+  "cocp_dmd",
   "codelists/user-elsie_horne-cocp_dmd.csv",
   column = "dmd_id"
 )
-hrt_dmd = codelist_from_csv(
+register_codelist(
+  "hrt_dmd",
   "codelists/user-elsie_horne-hrt_dmd.csv",
   column = "dmd_id"
 )
@@ -348,109 +504,161 @@ hrt_dmd = codelist_from_csv(
 # Dementia (Dem)
 
 # Alzheimer's disease
-dem_alz_snomed = codelist_from_csv(
+register_codelist(
+  "dem_alz_snomed",
   "codelists/bristol-alzheimers-disease-snomed-ct-v13.csv",
   column = "code",
 )
-dem_alz_icd10 = codelist_from_csv(
+register_codelist(
+  "dem_alz_icd10",
   "codelists/bristol-alzheimers-disease-icd10-v13.csv",
   column = "code",
 )
 
 # Vascular dementia
-dem_vasc_snomed = codelist_from_csv(
+register_codelist(
+  "dem_vasc_snomed",
   "codelists/bristol-vascular-dementia-snomed-ct-v13.csv",
   column = "code",
 )
-dem_vasc_icd10 = codelist_from_csv(
+register_codelist(
+  "dem_vasc_icd10",
   "codelists/bristol-vascular-dementia-icd10-v13.csv",
   column = "code",
 )
 
 # Lewy body disease
-dem_lb_snomed = codelist_from_csv(
+register_codelist(
+  "dem_lb_snomed",
   "codelists/bristol-lewy-body-dementia-snomed-v1.csv",
   column = "code"
 )
 
 # Other dementias
-dem_other_snomed = codelist_from_csv(
+register_codelist(
+  "dem_other_snomed",
   "codelists/bristol-other-dementias-snomed-ct-v13.csv",
   column = "code",
 )
-dem_other_icd10 = codelist_from_csv(
+register_codelist(
+  "dem_other_icd10",
   "codelists/bristol-other-dementias-icd10-v13.csv",
   column = "code",
 )
 
 # Unspecified dementias
-dem_unspec_snomed = codelist_from_csv(
+register_codelist(
+  "dem_unspec_snomed",
   "codelists/bristol-unspecified-dementia-snomed-ct-v13.csv",
   column = "code",
 )
-dem_unspec_icd10 = codelist_from_csv(
+register_codelist(
+  "dem_unspec_icd10",
   "codelists/bristol-unspecified-dementia-icd10-v13.csv",
   column = "code",
 )
 
 # Cognitive Impairment - Symptoms (CIS)
-cis_snomed = codelist_from_csv(
+register_codelist(
+  "cis_snomed",
   "codelists/opensafely-symptoms-cognitive-impairment.csv",
   column = "code",
 )
 
 # Parkinson's disease (Park)
-park_snomed = codelist_from_csv(
+register_codelist(
+  "park_snomed",
   "codelists/bristol-parkinsons-disease-snomed-ct-v13.csv",
   column = "code",
 )
-park_icd10 = codelist_from_csv(
+register_codelist(
+  "park_icd10",
   "codelists/bristol-parkinsons-disease-icd10-v13.csv",
   column = "code",
 )
 
 # Restless Leg Syndrome (RLS)
-rls_snomed = codelist_from_csv(
+register_codelist(
+  "rls_snomed",
   "codelists/bristol-restless-leg-syndrome-snomed-ct-v13.csv",
   column = "code",
 )
 
 # REM sleep disorder (RSD)
-rsd_snomed = codelist_from_csv(
+register_codelist(
+  "rsd_snomed",
   "codelists/bristol-rem-sleep-disorder-snomed-ct-v13.csv",
   column = "code",
 )
-rsd_icd10 = codelist_from_csv(
+register_codelist(
+  "rsd_icd10",
   "codelists/bristol-rem-sleep-disorder-icd10-v13.csv",
   column = "code",
 )
 
 # Migraine
-migraine_snomed = codelist_from_csv(
+register_codelist(
+  "migraine_snomed",
   "codelists/bristol-migraine-snomed-ct-v13.csv",
   column = "code",
 )
-migraine_icd10 = codelist_from_csv(
+register_codelist(
+  "migraine_icd10",
   "codelists/bristol-migraine-icd10-v13.csv",
   column = "code",
 )
 
 # Motor Neurone Disease (MND)
-mnd_snomed = codelist_from_csv(
+register_codelist(
+  "mnd_snomed",
   "codelists/bristol-motor-neurone-disease-snomed-ct-v13.csv",
   column = "code",
 )
-mnd_icd10 = codelist_from_csv(
+register_codelist(
+  "mnd_icd10",
   "codelists/bristol-motor-neurone-disease-icd10-v13.csv",
   column = "code",
 )
 
 # Multiple Sclerosis (MS)
-ms_snomed = codelist_from_csv(
+register_codelist(
+  "ms_snomed",
   "codelists/bristol-multiple-sclerosis-snomed-ct-v13.csv",
   column = "code",
 )
-ms_icd10 = codelist_from_csv(
+register_codelist(
+  "ms_icd10",
   "codelists/bristol-multiple-sclerosis-icd10-v13.csv",
   column = "code",
 )
+
+# Outcome codelists by category, for extracting the first date of every outcome (and for the
+# outcome prevalence in generate_synthetic_data.py)
+register_codelist_group(
+  "outcome_snomed",
+  cis = "cis_snomed",
+  dem_alz = "dem_alz_snomed",
+  dem_vasc = "dem_vasc_snomed",
+  dem_lb = "dem_lb_snomed",
+  dem_other = "dem_other_snomed",
+  dem_unspec = "dem_unspec_snomed",
+  migraine = "migraine_snomed",
+  mnd = "mnd_snomed",
+  ms = "ms_snomed",
+  park = "park_snomed",
+  rls = "rls_snomed",
+  rsd = "rsd_snomed",
+)
+
+register_codelist_group(
+  "outcome_icd10",
+  dem_alz = "dem_alz_icd10",
+  dem_vasc = "dem_vasc_icd10",
+  dem_other = "dem_other_icd10",
+  dem_unspec = "dem_unspec_icd10",
+  migraine = "migraine_icd10",
+  mnd = "mnd_icd10",
+  ms = "ms_icd10",
+  park = "park_icd10",
+  rsd = "rsd_icd10",
+)
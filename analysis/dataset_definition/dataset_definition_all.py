@@ -0,0 +1,39 @@
+from dataset_definition_cohorts import (
+    generate_multi_cohort_dataset,
+    get_cohort_dates,
+    parse_cohort_args,
+    read_variable_names,
+)
+
+args = parse_cohort_args()
+
+# extract index dates for all cohorts from index_dates.csv (or compute them inline with --inline-dates)
+
+cohort_dates = get_cohort_dates(inline_dates=args.inline_dates)
+
+# Create one dataset with cohort-suffixed columns for the prevax, vax and unvax cohorts
+
+dataset = generate_multi_cohort_dataset(
+    {
+        cohort: (
+            cohort_dates[f"index_{cohort}"],
+            cohort_dates[f"end_{cohort}_exposure"],
+            cohort_dates[f"end_{cohort}_outcome"],
+            cohort_dates[f"cens_date_dereg_{cohort}"],
+        )
+        for cohort in ["prevax", "vax", "unvax"]
+    },
+    inline_dates=args.inline_dates,
+    restrict_population=args.restrict_population,
+    prune=args.prune_variables,
+    variable_names=read_variable_names(args.variables),
+    shard=args.shard,
+    codelist_report=args.codelist_report,
+)
+
+# Describe the extracted variables for fn-preprocess.R (with --manifest)
+
+if args.manifest:
+    from variables_manifest import write_manifest
+
+    write_manifest(dataset, args.manifest)
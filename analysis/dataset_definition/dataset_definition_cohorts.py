@@ -11,79 +11,305 @@ from ehrql.query_language import table_from_file, PatientFrame, Series
 
 from datetime import date
 
+from argparse import ArgumentParser
+
+import json
+import sys
+
+from variable_helper_functions import all_of, any_of
+
 claim_permissions("appointments")
 
+# Parse arguments passed to the dataset definition, e.g.
+# ehrql generate-dataset dataset_definition_prevax.py --output ... -- --inline-dates --restrict-population --prune-variables
+
+def parse_shard(value):
+    shard, shards = (int(part) for part in value.split("/"))
+    if not 0 <= shard < shards:
+        raise ValueError(value)
+    return shard, shards
+
+def parse_cohort_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--inline-dates",
+        action="store_true",
+        help="compute the vaccination, JCVI and cohort dates inline instead of reading index_dates.csv.gz",
+    )
+    parser.add_argument(
+        "--restrict-population",
+        action="store_true",
+        help="only extract patients who meet the inclusion criteria applied to all cohorts in fn-inex.R",
+    )
+    parser.add_argument(
+        "--prune-variables",
+        action="store_true",
+        help="only extract the variables used by the cohort's analyses in lib/active_analyses.json",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="only extract shard I of K of the population, given as I/K with I from 0 (see extract_sharded.py)",
+    )
+    parser.add_argument(
+        "--variables",
+        help="only extract the variables listed in this JSON file (from variables_fingerprint.py)",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="write a JSON manifest of the extracted variables to this path (see variables_manifest.py)",
+    )
+    parser.add_argument(
+        "--codelist-report",
+        action="store_true",
+        help="write the codelists loaded and their load times to stderr (see codelists.import_report)",
+    )
+    parser.add_argument(
+        "--cohort",
+        choices=["prevax", "vax", "unvax"],
+        help="cohort to count the inclusion criteria flow for (measures_inex.py)",
+    )
+    return parser.parse_args()
+
+# Names of the variables to extract with --variables, or None to extract all of them
+
+def read_variable_names(path):
+    if path is None:
+        return None
+    with open(path) as f:
+        return set(json.load(f)["variables"])
+
+# Get index and end dates for all cohorts, either from index_dates.csv or computed inline
+
+def get_cohort_dates(inline_dates=False):
+    if inline_dates:
+        from variables_dates import generate_cohort_dates
+
+        return generate_cohort_dates()
+
+    @table_from_file("output/dataset_definition/index_dates.csv.gz")
+
+    class index_dates(PatientFrame):
+        index_prevax = Series(date)
+        end_prevax_exposure = Series(date)
+        end_prevax_outcome = Series(date)
+        index_vax = Series(date)
+        end_vax_exposure = Series(date)
+        end_vax_outcome = Series(date)
+        index_unvax = Series(date)
+        end_unvax_exposure = Series(date)
+        end_unvax_outcome = Series(date)
+        cens_date_dereg_prevax = Series(date)
+        cens_date_dereg_vax = Series(date)
+        cens_date_dereg_unvax = Series(date)
+
+    return dict(
+        index_prevax=index_dates.index_prevax,
+        end_prevax_exposure=index_dates.end_prevax_exposure,
+        end_prevax_outcome=index_dates.end_prevax_outcome,
+        index_vax=index_dates.index_vax,
+        end_vax_exposure=index_dates.end_vax_exposure,
+        end_vax_outcome=index_dates.end_vax_outcome,
+        index_unvax=index_dates.index_unvax,
+        end_unvax_exposure=index_dates.end_unvax_exposure,
+        end_unvax_outcome=index_dates.end_unvax_outcome,
+        cens_date_dereg_prevax=index_dates.cens_date_dereg_prevax,
+        cens_date_dereg_vax=index_dates.cens_date_dereg_vax,
+        cens_date_dereg_unvax=index_dates.cens_date_dereg_unvax,
+    )
+
+# Get the variables that do not depend on the index date, either from index_dates.csv (where they are
+# extracted once for all cohorts) or computed inline
+
+def get_shared_variables(inline_dates=False):
+    if inline_dates:
+        from variables_shared import generate_shared_variables
+
+        return generate_shared_variables()
+
+    @table_from_file("output/dataset_definition/index_dates.csv.gz")
+
+    class index_dates(PatientFrame):
+        qa_num_birth_year = Series(int)
+        cov_cat_sex = Series(str)
+        tmp_cov_cat_ethnicity_sus = Series(str)
+        cov_num_consrate2019 = Series(int)
+        cov_bin_hcworker = Series(bool)
+
+    return dict(
+        qa_num_birth_year=index_dates.qa_num_birth_year,
+        cov_cat_sex=index_dates.cov_cat_sex,
+        tmp_cov_cat_ethnicity_sus=index_dates.tmp_cov_cat_ethnicity_sus,
+        cov_num_consrate2019=index_dates.cov_num_consrate2019,
+        cov_bin_hcworker=index_dates.cov_bin_hcworker,
+    )
+
+# Shard of the population for sharded extraction (extract_sharded.py). ehrQL does not expose
+# patient_id, so patients are assigned to shards by their month of birth
+
+def in_shard(shard, shards):
+    birth_month = patients.date_of_birth.year * 12 + patients.date_of_birth.month
+    return birth_month - (birth_month // shards) * shards == shard
+
 # Create dataset
 
-def generate_dataset(index_date, end_date_exp, end_date_out):
+def create_cohort_dataset(inclusion=None, shard=None):
     dataset = create_dataset()
-    
-    dataset.define_population(
-        patients.date_of_birth.is_not_null()
-    )
+
+    # With --restrict-population, patients who fail the inclusion criteria (see
+    # generate_inex_criteria) are excluded here rather than in fn-inex.R
+
+    population = patients.date_of_birth.is_not_null()
+    if inclusion is not None:
+        population = population & inclusion
+    if shard is not None:
+        population = population & in_shard(*shard)
+
+    dataset.define_population(population)
 
 # Configure dummy data
 
     dataset.configure_dummy_data(population_size=5000)
 
+    return dataset
+
+def generate_dataset(
+    index_date, end_date_exp, end_date_out, inline_dates=False, cens_date_dereg=None, restrict_population=False,
+    cohort=None, prune=False, variable_names=None, shard=None, codelist_report=False,
+):
+
 # Import variables function
 
-    from variables_cohorts import generate_variables
+    from variables_cohorts import generate_variables, generate_inex_criteria
+
+    variables = generate_variables(
+        index_date, end_date_exp, end_date_out, get_shared_variables(inline_dates), cens_date_dereg
+    )
+
+    inclusion = None
+    if restrict_population:
+        inclusion = all_of(generate_inex_criteria(variables, index_date, end_date_exp).values())
+
+    dataset = create_cohort_dataset(inclusion, shard)
 
-    variables = generate_variables(index_date, end_date_exp, end_date_out)
+    # With --prune-variables, drop the variables that none of the cohort's active analyses use
+    # (see variables_required.py); the inclusion criteria above are built before pruning
+
+    if prune:
+        from variables_required import prune_variables
+
+        variables = prune_variables(variables, cohort)
+
+    # With --variables, only re-extract the listed variables (merged into the previous extraction by
+    # merge_extraction.py)
+
+    if variable_names is not None:
+        variables = {name: value for name, value in variables.items() if name in variable_names}
 
     # Assign each variable to the dataset
 
     for var_name, var_value in variables.items():
         setattr(dataset, var_name, var_value)
 
-# Extract date variables for later pipelines
+    # With --codelist-report, report which codelists were loaded
 
-    @table_from_file("output/dataset_definition/index_dates.csv.gz")
-    
-    class index_dates(PatientFrame):
-    # Vaccine category and eligibility variables
-        vax_cat_jcvi_group = Series(str)
-        vax_date_eligible = Series(date)
+    if codelist_report:
+        from codelists import import_report
 
-    # General COVID vaccination dates
-        vax_date_covid_1 = Series(date)
-        vax_date_covid_2 = Series(date)
-        vax_date_covid_3 = Series(date)
+        print(import_report(), file=sys.stderr)
 
-    # Pfizer vaccine-specific dates
-        vax_date_Pfizer_1 = Series(date)
-        vax_date_Pfizer_2 = Series(date)
-        vax_date_Pfizer_3 = Series(date)
+    add_index_date_variables(dataset, inline_dates)
 
-    # AstraZeneca vaccine-specific dates
-        vax_date_AstraZeneca_1 = Series(date)
-        vax_date_AstraZeneca_2 = Series(date)
-        vax_date_AstraZeneca_3 = Series(date)
+    return dataset
 
-    # Moderna vaccine-specific dates
-        vax_date_Moderna_1 = Series(date)
-        vax_date_Moderna_2 = Series(date)
-        vax_date_Moderna_3 = Series(date)
+# Create one wide dataset for several cohorts, with cohort-suffixed columns (e.g. out_date_ms_vax)
+# cohorts is a dictionary of cohort name -> (index date, end date of exposure, end date of outcome,
+# deregistration date from the dates stage)
 
-    # Censoring date due to death
-        cens_date_death = Series(date)
+def generate_multi_cohort_dataset(
+    cohorts, inline_dates=False, restrict_population=False, prune=False, variable_names=None, shard=None,
+    codelist_report=False,
+):
+    from variables_cohorts import generate_variables, generate_inex_criteria
 
-    # Mapping all variables from index_dates to the dataset
-    dataset.vax_cat_jcvi_group = index_dates.vax_cat_jcvi_group
-    dataset.vax_date_eligible = index_dates.vax_date_eligible
-    dataset.vax_date_covid_1 = index_dates.vax_date_covid_1
-    dataset.vax_date_covid_2 = index_dates.vax_date_covid_2
-    dataset.vax_date_covid_3 = index_dates.vax_date_covid_3
-    dataset.vax_date_Pfizer_1 = index_dates.vax_date_Pfizer_1
-    dataset.vax_date_Pfizer_2 = index_dates.vax_date_Pfizer_2
-    dataset.vax_date_Pfizer_3 = index_dates.vax_date_Pfizer_3
-    dataset.vax_date_AstraZeneca_1 = index_dates.vax_date_AstraZeneca_1
-    dataset.vax_date_AstraZeneca_2 = index_dates.vax_date_AstraZeneca_2
-    dataset.vax_date_AstraZeneca_3 = index_dates.vax_date_AstraZeneca_3
-    dataset.vax_date_Moderna_1 = index_dates.vax_date_Moderna_1
-    dataset.vax_date_Moderna_2 = index_dates.vax_date_Moderna_2
-    dataset.vax_date_Moderna_3 = index_dates.vax_date_Moderna_3
-    dataset.cens_date_death = index_dates.cens_date_death
+    # Variables that do not depend on the index date (e.g. sex, healthcare worker) are identical for
+    # every cohort, so they are read (or built) once and shared between the cohorts
+
+    shared_variables = get_shared_variables(inline_dates)
+
+    columns = {}
+    inclusions = []
+
+    for cohort, (index_date, end_date_exp, end_date_out, cens_date_dereg) in cohorts.items():
+        variables = generate_variables(
+            index_date, end_date_exp, end_date_out, shared_variables, cens_date_dereg
+        )
+
+        inclusions.append(all_of(generate_inex_criteria(variables, index_date, end_date_exp).values()))
+
+        if prune:
+            from variables_required import prune_variables
+
+            variables = prune_variables(variables, cohort)
+
+        for var_name, var_value in variables.items():
+            if variable_names is None or f"{var_name}_{cohort}" in variable_names:
+                columns[f"{var_name}_{cohort}"] = var_value
+
+        columns[f"index_date_{cohort}"] = index_date
+        columns[f"end_date_exposure_{cohort}"] = end_date_exp
+        columns[f"end_date_outcome_{cohort}"] = end_date_out
+
+    # With --restrict-population, keep patients who meet the inclusion criteria for any cohort;
+    # fn-inex.R still applies each cohort's criteria to its own columns
+
+    dataset = create_cohort_dataset(any_of(inclusions) if restrict_population else None, shard)
+
+    for var_name, var_value in columns.items():
+        setattr(dataset, var_name, var_value)
+
+    if codelist_report:
+        from codelists import import_report
+
+        print(import_report(), file=sys.stderr)
+
+    add_index_date_variables(dataset, inline_dates)
 
     return dataset
+
+# Extract date variables for later pipelines, either from index_dates.csv or computed inline
+
+def add_index_date_variables(dataset, inline_dates=False):
+    if inline_dates:
+        from variables_dates import prelim_date_variables, jcvi_variables
+
+        dataset.vax_cat_jcvi_group = jcvi_variables["vax_cat_jcvi_group"]
+        dataset.vax_date_eligible = jcvi_variables["vax_date_eligible"]
+
+        for var_name, var_value in prelim_date_variables.items():
+            setattr(dataset, var_name, var_value)
+
+        return
+
+    from variables_shared import vax_doses, vax_groups
+
+    # Vaccine category and eligibility, COVID vaccination dates for each group (overall and each
+    # product) and dose up to vax_doses as written by the dates stage, and censoring date due to death
+    columns = dict(
+        vax_cat_jcvi_group=Series(str),
+        vax_date_eligible=Series(date),
+        **{
+            f"vax_date_{group}_{dose}": Series(date)
+            for group in vax_groups
+            for dose in range(1, vax_doses + 1)
+        },
+        cens_date_death=Series(date),
+    )
+
+    index_dates = table_from_file("output/dataset_definition/index_dates.csv.gz")(
+        type("index_dates", (PatientFrame,), columns)
+    )
+
+    # Mapping all variables from index_dates to the dataset
+    for var_name in columns:
+        setattr(dataset, var_name, getattr(index_dates, var_name))
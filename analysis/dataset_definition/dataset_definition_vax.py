@@ -1,26 +1,40 @@
-from dataset_definition_cohorts import generate_dataset
+from dataset_definition_cohorts import (
+    generate_dataset,
+    get_cohort_dates,
+    parse_cohort_args,
+    read_variable_names,
+)
 
-from ehrql.query_language import table_from_file, PatientFrame, Series
+args = parse_cohort_args()
 
-from datetime import date
+# extract index dates for vax cohort from index_dates.csv (or compute them inline with --inline-dates)
 
-# extract index dates for vax cohort from index_dates.csv
+cohort_dates = get_cohort_dates(inline_dates=args.inline_dates)
 
-@table_from_file("output/dataset_definition/index_dates.csv.gz")
-
-class index_dates(PatientFrame):
-    index_vax = Series(date)
-    end_vax_exposure = Series(date)
-    end_vax_outcome = Series(date)
-
-index_date = index_dates.index_vax
-end_date_exposure = index_dates.end_vax_exposure
-end_date_outcome = index_dates.end_vax_outcome
+index_date = cohort_dates["index_vax"]
+end_date_exposure = cohort_dates["end_vax_exposure"]
+end_date_outcome = cohort_dates["end_vax_outcome"]
 
 # Create dataset
 
-dataset = generate_dataset(index_date, end_date_exposure, end_date_outcome)
+dataset = generate_dataset(
+    index_date, end_date_exposure, end_date_outcome, inline_dates=args.inline_dates,
+    cens_date_dereg=cohort_dates["cens_date_dereg_vax"],
+    restrict_population=args.restrict_population,
+    cohort="vax",
+    prune=args.prune_variables,
+    variable_names=read_variable_names(args.variables),
+    shard=args.shard,
+    codelist_report=args.codelist_report,
+)
 
 dataset.index_date = index_date
 dataset.end_date_exposure = end_date_exposure
-dataset.end_date_outcome = end_date_outcome
\ No newline at end of file
+dataset.end_date_outcome = end_date_outcome
+
+# Describe the extracted variables for fn-preprocess.R (with --manifest)
+
+if args.manifest:
+    from variables_manifest import write_manifest
+
+    write_manifest(dataset, args.manifest)
@@ -0,0 +1,222 @@
+# Sharded cohort extraction
+#
+# Runs a cohort definition as K independent extractions, each restricted to one shard of the
+# population with --shard I/K (see in_shard in dataset_definition_cohorts.py), and merges the shard
+# outputs in patient_id order. A failed shard can be re-run on its own, and the shards can run in
+# parallel. A JSON manifest records the rows and content hash of each shard and of the merged output.
+#
+# Run from the repository root, e.g.:
+#   python analysis/dataset_definition/extract_sharded.py run dataset_definition_prevax.py \
+#     --output output/dataset_definition/input_prevax.arrow --shards 8 --workers 4 -- --inline-dates
+#   python analysis/dataset_definition/extract_sharded.py merge \
+#     --output output/dataset_definition/input_prevax.arrow output/dataset_definition/input_prevax_shard_*.arrow
+#   python analysis/dataset_definition/extract_sharded.py check dataset_definition_prevax.py --shards 4
+#
+# check runs the definition with and without sharding against the same dummy tables (created with
+# ehrql create-dummy-tables) and compares the merged output with the unsharded one.
+
+import csv
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+DEFINITION_DIR = "analysis/dataset_definition"
+
+# Shard files -----------------------------------------------------------------------------------
+
+def split_extension(path):
+    for extension in [".csv.gz", ".csv", ".arrow"]:
+        if path.endswith(extension):
+            return path[: -len(extension)], extension
+    sys.exit(f"Unsupported output format: {path}")
+
+def shard_path(output, shard, shards):
+    stem, extension = split_extension(output)
+    return f"{stem}_shard_{shard + 1}of{shards}{extension}"
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Extraction ------------------------------------------------------------------------------------
+
+def extract(definition, output, user_args, ehrql="ehrql", dummy_tables=None):
+    command = [
+        *shlex.split(ehrql),
+        "generate-dataset",
+        f"{DEFINITION_DIR}/{definition}",
+        "--output",
+        output,
+        *(["--dummy-tables", dummy_tables] if dummy_tables else []),
+    ]
+    if user_args:
+        command += ["--", *user_args]
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+    return result.returncode == 0, seconds
+
+def extract_shards(definition, output, shards, user_args, workers, ehrql="ehrql", dummy_tables=None, retries=1):
+    def run_shard(shard):
+        path = shard_path(output, shard, shards)
+        for attempt in range(retries + 1):
+            ok, seconds = extract(
+                definition, path, [*user_args, "--shard", f"{shard}/{shards}"], ehrql, dummy_tables
+            )
+            print(f"  shard {shard + 1}/{shards}: {'done' if ok else 'FAILED'} in {seconds:.1f} s (attempt {attempt + 1})")
+            if ok:
+                return path
+        sys.exit(f"Shard {shard + 1}/{shards} failed; re-run it with --shard {shard}/{shards}")
+
+    # Each shard is a separate ehrql process, so threads are enough to run them in parallel
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run_shard, range(shards)))
+
+# Merge -----------------------------------------------------------------------------------------
+
+def _open_csv(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", newline="")
+    return open(path, mode, newline="")
+
+def _in_patient_order(reader, path):
+    previous = None
+    for row in reader:
+        patient_id = int(row[0])
+        if previous is not None and patient_id < previous:
+            sys.exit(f"{path} is not in patient_id order")
+        previous = patient_id
+        yield row
+
+def merge_csv(paths, output):
+    # ehrQL writes each shard in patient_id order, so the shards are merged row by row
+    files = [_open_csv(path, "r") for path in paths]
+    readers = [csv.reader(f) for f in files]
+    headers = [next(reader) for reader in readers]
+    if any(header != headers[0] for header in headers):
+        sys.exit("The shards have different columns")
+    rows = 0
+    with _open_csv(output, "w") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(headers[0])
+        ordered = [_in_patient_order(reader, path) for reader, path in zip(readers, paths)]
+        for row in heapq.merge(*ordered, key=lambda row: int(row[0])):
+            writer.writerow(row)
+            rows += 1
+    for f in files:
+        f.close()
+    return rows
+
+def merge_arrow(paths, output):
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    tables = [feather.read_table(path) for path in paths]
+    if any(table.schema != tables[0].schema for table in tables):
+        sys.exit("The shards have different columns")
+    merged = pa.concat_tables(tables).sort_by("patient_id")
+    feather.write_feather(merged, output)
+    return merged.num_rows
+
+def count_rows(path):
+    if path.endswith(".arrow"):
+        import pyarrow.feather as feather
+
+        return feather.read_table(path, columns=["patient_id"]).num_rows
+    with _open_csv(path, "r") as f:
+        return sum(1 for _ in f) - 1
+
+def merge_shards(paths, output):
+    _, extension = split_extension(output)
+    rows = merge_arrow(paths, output) if extension == ".arrow" else merge_csv(paths, output)
+    shards = [dict(path=path, rows=count_rows(path), sha256=file_hash(path)) for path in paths]
+
+    # A patient is in exactly one shard, so the merged output has the rows of all the shards
+    if rows != sum(shard["rows"] for shard in shards):
+        sys.exit(f"Merged {rows} rows from shards with {sum(shard['rows'] for shard in shards)} rows")
+
+    manifest = dict(output=output, rows=rows, sha256=file_hash(output), shards=shards)
+    with open(f"{split_extension(output)[0]}_shards.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Merged {len(paths)} shards into {output}: {rows} rows")
+    return manifest
+
+# Check -----------------------------------------------------------------------------------------
+
+def read_rows(path):
+    with _open_csv(path, "r") as f:
+        return list(csv.reader(f))
+
+def check(definition, shards, user_args, workers, ehrql="ehrql", dummy_tables=None):
+    with tempfile.TemporaryDirectory() as tmp:
+        if dummy_tables is None:
+            dummy_tables = os.path.join(tmp, "dummy_tables")
+            command = [*shlex.split(ehrql), "create-dummy-tables", f"{DEFINITION_DIR}/{definition}", dummy_tables]
+            subprocess.run(command + (["--", *user_args] if user_args else []), check=True)
+
+        unsharded = os.path.join(tmp, "unsharded.csv")
+        if not extract(definition, unsharded, user_args, ehrql, dummy_tables)[0]:
+            sys.exit("The unsharded extraction failed")
+
+        sharded = os.path.join(tmp, "sharded.csv")
+        paths = extract_shards(definition, sharded, shards, user_args, workers, ehrql, dummy_tables)
+        merge_shards(paths, sharded)
+
+        expected, merged = read_rows(unsharded), read_rows(sharded)
+        if expected == merged:
+            print(f"OK: the merged output of {shards} shards equals the unsharded output ({len(expected) - 1} rows)")
+            return True
+        print(f"DIFFERENT: unsharded {len(expected) - 1} rows, sharded {len(merged) - 1} rows")
+        return False
+
+# Main ------------------------------------------------------------------------------------------
+
+def main():
+    parser = ArgumentParser(description="Extract a cohort in shards and merge them in patient_id order")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command in ["run", "check"]:
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument("definition", help=f"dataset definition in {DEFINITION_DIR}")
+        subparser.add_argument("--shards", type=int, default=4)
+        subparser.add_argument("--workers", type=int, default=os.cpu_count())
+        subparser.add_argument("--ehrql", default="ehrql", help="command that runs ehrQL, e.g. 'opensafely exec ehrql:v1'")
+        subparser.add_argument("--dummy-tables", help="run against these dummy tables")
+        subparser.add_argument("user_args", nargs="*", help="arguments of the cohort definition (after --)")
+        if command == "run":
+            subparser.add_argument("--output", required=True)
+
+    merge_parser = subparsers.add_parser("merge")
+    merge_parser.add_argument("--output", required=True)
+    merge_parser.add_argument("shards", nargs="+")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        start = time.perf_counter()
+        paths = extract_shards(
+            args.definition, args.output, args.shards, args.user_args, args.workers, args.ehrql, args.dummy_tables
+        )
+        merge_shards(paths, args.output)
+        print(f"Extracted {args.shards} shards in {time.perf_counter() - start:.1f} s")
+    elif args.command == "merge":
+        merge_shards(args.shards, args.output)
+    elif not check(args.definition, args.shards, args.user_args, args.workers, args.ehrql, args.dummy_tables):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+# Synthetic TPP data
+#
+# Generates the TPP tables used by the dataset definitions for millions of patients, as one Parquet
+# file per table for local_backend.py load. Unlike ehrQL's dummy data, the clinical codes are drawn from
+# the project's codelists, so each outcome and covariate is present in a chosen share of patients
+# (its prevalence), and the event dates fall before and within the study windows in
+# output/study_dates.json. Every column is drawn with NumPy for many patients at once.
+#
+# Each codelist's codes are written to the table the dataset definitions search for its coding system:
+#   SNOMED CT - clinical_events.snomedct_code (and a share to emergency_care_attendances.diagnosis_01)
+#   CTV3      - clinical_events.ctv3_code
+#   ICD-10    - apcs.primary_diagnosis and all_diagnoses (and the causes of death in ons_deaths)
+#   dm+d      - medications.dmd_code
+# alongside background events with codes from none of the codelists.
+#
+# Run from the repository root, e.g.:
+#   python analysis/dataset_definition/generate_synthetic_data.py --patients 1000000 --output synthetic
+#   python analysis/dataset_definition/generate_synthetic_data.py --patients 1000000 --output synthetic \
+#     --prevalence dem_alz_snomed=0.02 --prevalence park_icd10=0.005
+# --config reads the prevalence of each codelist from a JSON file ({"dem_alz_snomed": 0.02, ...}).
+
+import json
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import codelists
+
+STUDY_DATES_PATH = "output/study_dates.json"
+
+# Events before the pandemic start from this date
+HISTORY_START = "2000-01-01"
+
+# Default prevalence: the share of patients with at least one event from a codelist
+default_prevalence = dict(
+    outcome=0.01,
+    covariate=0.05,
+    ethnicity_snomed=0.8,
+    smoking_clear=0.6,
+    smoking_unclear=0.1,
+)
+
+# Mean number of further events for a patient with an event from a codelist
+REPEAT_EVENTS = 0.5
+
+# Mean number of events per patient with codes from none of the codelists
+background_rates = dict(clinical_events=5.0, medications=3.0, apcs=0.2)
+
+# Background events, tests and appointments are generated for this many patients at a time
+CHUNK_SIZE = 1_000_000
+
+# Coding system of the codelists whose names do not end in _snomed, _icd10, _ctv3 or _dmd
+coding_systems = dict(
+    covid_codes="icd10",
+    covid_primary_care_positive_test="ctv3",
+    covid_primary_care_code="ctv3",
+    covid_primary_care_sequalae="ctv3",
+    smoking_clear="ctv3",
+    smoking_unclear="ctv3",
+    astrx_primis="dmd",
+    immrx_primis="dmd",
+)
+
+# Codelists recorded with a numeric value (mean, standard deviation)
+numeric_values = dict(bmi_primis=(27.5, 5.5))
+
+regions = [
+    "East",
+    "East Midlands",
+    "London",
+    "North East",
+    "North West",
+    "South East",
+    "South West",
+    "West Midlands",
+    "Yorkshire and The Humber",
+]
+
+vaccine_products = dict(
+    Pfizer="COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
+    AstraZeneca="COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)",
+    Moderna="COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
+)
+
+appointment_statuses = [
+    "Arrived",
+    "In Progress",
+    "Finished",
+    "Visit",
+    "Waiting",
+    "Patient Walked Out",
+    "Did Not Attend",
+    "Cancelled by Patient",
+]
+
+sus_ethnicity_codes = list("ABCDEFGHJKLMNPRS") + ["Z"]
+
+# Codelists -------------------------------------------------------------------------------------
+
+def coding_system(name):
+    if name in coding_systems:
+        return coding_systems[name]
+    for system in ["icd10", "ctv3", "dmd"]:
+        if name.endswith(f"_{system}"):
+            return system
+    return "snomed"
+
+def outcome_codelists():
+    return set(codelists.group_members("outcome_snomed")) | set(codelists.group_members("outcome_icd10"))
+
+def codelist_prevalence(names, overrides):
+    outcomes = outcome_codelists()
+    prevalence = {}
+    for name in names:
+        if name in overrides:
+            prevalence[name] = overrides[name]
+        elif name in default_prevalence:
+            prevalence[name] = default_prevalence[name]
+        else:
+            prevalence[name] = default_prevalence["outcome" if name in outcomes else "covariate"]
+    return prevalence
+
+def read_codelists():
+    codelists.load_all()
+    return {name: sorted(set(codelist)) for name, (_, codelist) in codelists.loaded_codelists().items()}
+
+def background_codes(rng, system, used, size=500):
+    # Codes from none of the codelists, in the format of the coding system
+    if system == "icd10":
+        codes = [f"{letter}{number:03d}" for letter, number in zip(rng.choice(list("RZ"), size), rng.integers(0, 1000, size))]
+    elif system == "ctv3":
+        codes = [f"Y{number:04X}" for number in rng.integers(0, 0x10000, size)]
+    elif system == "dmd":
+        codes = [str(number) for number in rng.integers(10**13, 10**14, size)]
+    else:
+        codes = [str(number) for number in rng.integers(10**8, 10**10, size)]
+    return sorted(set(codes) - used)
+
+# Columns ---------------------------------------------------------------------------------------
+
+def day(value):
+    return np.datetime64(value, "D")
+
+def random_dates(rng, start, end, size):
+    days = (day(end) - day(start)).astype(int) + 1
+    return day(start) + rng.integers(0, days, size).astype("timedelta64[D]")
+
+def event_dates(rng, dates, size, follow_up_share):
+    # A share of the events falls in follow-up (from the pandemic start), the rest in the history before it
+    follow_up = rng.random(size) < follow_up_share
+    history = random_dates(rng, HISTORY_START, day(dates["pandemic_start"]) - 1, size)
+    return np.where(follow_up, random_dates(rng, dates["pandemic_start"], dates["lcd_date"], size), history)
+
+def nullable(values, is_null):
+    return pa.array(values, mask=is_null)
+
+def take_codes(rng, codes, size):
+    return pa.array(codes).take(pa.array(rng.integers(0, len(codes), size)))
+
+def nulls(size, type_=pa.string()):
+    return pa.nulls(size, type_)
+
+# Output ----------------------------------------------------------------------------------------
+
+class TableWriter:
+    # One Parquet file per table, written a chunk at a time
+    def __init__(self, output):
+        self.output = output
+        self.writers = {}
+        self.rows = {}
+
+    def write(self, table, columns):
+        chunk = pa.table(columns)
+        if table not in self.writers:
+            self.writers[table] = pq.ParquetWriter(os.path.join(self.output, f"{table}.parquet"), chunk.schema)
+            self.rows[table] = 0
+        self.writers[table].write_table(chunk)
+        self.rows[table] += chunk.num_rows
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+# Tables ----------------------------------------------------------------------------------------
+
+def generate_patients(rng, writer, patients, dates):
+    patient_id = np.arange(1, patients + 1)
+    date_of_birth = random_dates(rng, "1915-01-01", "2004-12-31", patients)
+    # ehrQL rounds dates of birth to the first of the month
+    date_of_birth = date_of_birth.astype("datetime64[M]").astype("datetime64[D]")
+    dead = rng.random(patients) < 0.05
+    date_of_death = random_dates(rng, dates["pandemic_start"], dates["lcd_date"], patients)
+    writer.write("patients", dict(
+        patient_id=patient_id,
+        date_of_birth=date_of_birth,
+        sex=rng.choice(["female", "male", "intersex", "unknown"], patients, p=[0.5, 0.495, 0.001, 0.004]),
+        date_of_death=nullable(date_of_death, ~dead),
+    ))
+
+    # One registration and address per patient; a few registrations end during the study
+    registered = random_dates(rng, "1990-01-01", "2020-12-31", patients)
+    ended = rng.random(patients) < 0.05
+    registration_end = registered + rng.integers(180, 365 * 10, patients).astype("timedelta64[D]")
+    writer.write("practice_registrations", dict(
+        patient_id=patient_id,
+        start_date=registered,
+        end_date=nullable(registration_end, ~ended),
+        practice_pseudo_id=rng.integers(1, 7000, patients),
+        practice_stp=pa.array(rng.integers(1, 43, patients)).cast(pa.string()),
+        practice_nuts1_region_name=rng.choice(regions, patients),
+    ))
+    care_home = rng.random(patients) < 0.01
+    writer.write("addresses", dict(
+        patient_id=patient_id,
+        address_id=patient_id,
+        start_date=registered,
+        end_date=nulls(patients, pa.date32()),
+        address_type=np.ones(patients, dtype=np.int64),
+        rural_urban_classification=rng.integers(1, 9, patients),
+        imd_rounded=rng.integers(0, 329, patients) * 100,
+        msoa_code=pa.array(rng.integers(1, 7202, patients)).cast(pa.string()),
+        has_postcode=rng.random(patients) < 0.98,
+        care_home_is_potential_match=care_home,
+        care_home_requires_nursing=care_home & (rng.random(patients) < 0.5),
+        care_home_does_not_require_nursing=care_home & (rng.random(patients) < 0.5),
+    ))
+
+    writer.write("ethnicity_from_sus", dict(
+        patient_id=patient_id,
+        code=nullable(rng.choice(sus_ethnicity_codes, patients), rng.random(patients) < 0.1),
+    ))
+    healthcare_workers = patient_id[rng.random(patients) < 0.05]
+    writer.write("occupation_on_covid_vaccine_record", dict(
+        patient_id=healthcare_workers,
+        is_healthcare_worker=np.ones(len(healthcare_workers), dtype=bool),
+    ))
+    return date_of_birth, np.where(dead, date_of_death, day("9999-12-31"))
+
+def event_patients(rng, patients, prevalence):
+    # Patients with at least one event, each with a Poisson number of repeat events
+    with_event = np.sort(rng.choice(patients, rng.binomial(patients, prevalence), replace=False)) + 1
+    return np.repeat(with_event, 1 + rng.poisson(REPEAT_EVENTS, len(with_event)))
+
+def background_patients(rng, patients, rate):
+    # Patient ids with a Poisson number of rows each, a chunk of patients at a time
+    for first in range(1, patients + 1, CHUNK_SIZE):
+        chunk = np.arange(first, min(first + CHUNK_SIZE, patients + 1))
+        yield np.repeat(chunk, rng.poisson(rate, len(chunk)))
+
+def write_events(rng, writer, system, patient_id, codes, dates, name=None, ec_share=0.2):
+    size = len(patient_id)
+    code = take_codes(rng, codes, size)
+    if system in ["snomed", "ctv3"]:
+        if name in numeric_values:
+            mean, sd = numeric_values[name]
+            numeric_value = pa.array(np.round(rng.normal(mean, sd, size), 1))
+        else:
+            numeric_value = nulls(size, pa.float64())
+        writer.write("clinical_events", dict(
+            patient_id=patient_id,
+            date=dates,
+            snomedct_code=code if system == "snomed" else nulls(size),
+            ctv3_code=code if system == "ctv3" else nulls(size),
+            numeric_value=numeric_value,
+        ))
+        if system == "snomed" and name is not None:
+            # A share of the diagnoses are also recorded at emergency care attendances
+            attended = rng.random(size) < ec_share
+            attendances = int(attended.sum())
+            writer.write("emergency_care_attendances", dict(
+                patient_id=patient_id[attended],
+                arrival_date=dates[attended],
+                diagnosis_01=code.filter(pa.array(attended)),
+                **{f"diagnosis_{i:02d}": nulls(attendances) for i in range(2, 25)},
+            ))
+    elif system == "icd10":
+        writer.write("apcs", dict(
+            patient_id=patient_id,
+            admission_date=dates,
+            discharge_date=dates + rng.integers(0, 15, size).astype("timedelta64[D]"),
+            primary_diagnosis=code,
+            secondary_diagnosis=nulls(size),
+            all_diagnoses=pc.binary_join_element_wise("||", code, ""),
+        ))
+    else:
+        writer.write("medications", dict(patient_id=patient_id, date=dates, dmd_code=code))
+
+def generate_events(rng, writer, patients, dates, date_of_birth, codes, prevalence, follow_up_share):
+    used = {system: set() for system in ["snomed", "ctv3", "icd10", "dmd"]}
+    for name, codelist in codes.items():
+        system = coding_system(name)
+        used[system].update(codelist)
+        if not codelist or prevalence[name] <= 0:
+            continue
+        patient_id = event_patients(rng, patients, prevalence[name])
+        # No events before birth
+        event_date = np.maximum(event_dates(rng, dates, len(patient_id), follow_up_share), date_of_birth[patient_id - 1])
+        write_events(rng, writer, system, patient_id, codelist, event_date, name)
+
+    pools = {system: background_codes(rng, system, used_codes) for system, used_codes in used.items()}
+    for table, systems in [("clinical_events", ["snomed", "ctv3"]), ("medications", ["dmd"]), ("apcs", ["icd10"])]:
+        for system in systems:
+            for patient_id in background_patients(rng, patients, background_rates[table] / len(systems)):
+                event_date = np.maximum(event_dates(rng, dates, len(patient_id), follow_up_share), date_of_birth[patient_id - 1])
+                write_events(rng, writer, system, patient_id, pools[system], event_date)
+    return pools["icd10"]
+
+def generate_deaths(rng, writer, patients, dates, death_date, codes, background):
+    # Causes of death are drawn from the ICD-10 codelists (as often as their prevalence) and the background codes
+    dead = np.flatnonzero(death_date < day("9999-12-31"))
+    icd10 = [name for name in codes if coding_system(name) == "icd10" and codes[name]]
+    causes = sorted({code for name in icd10 for code in codes[name]})
+    from_codelist = rng.random(len(dead)) < 0.3
+    cause = np.where(
+        from_codelist,
+        np.array(causes, dtype=object)[rng.integers(0, len(causes), len(dead))],
+        np.array(background, dtype=object)[rng.integers(0, len(background), len(dead))],
+    )
+    writer.write("ons_deaths", dict(
+        patient_id=dead + 1,
+        date=death_date[dead],
+        underlying_cause_of_death=pa.array(cause, pa.string()),
+        cause_of_death_01=pa.array(cause, pa.string()),
+        **{f"cause_of_death_{i:02d}": nulls(len(dead)) for i in range(2, 16)},
+    ))
+
+def generate_covid(rng, writer, patients, dates):
+    # Up to three doses, the second 8-12 weeks after the first and the third 6-8 months after the second
+    vaccinated = np.flatnonzero(rng.random(patients) < 0.85) + 1
+    dose_1 = random_dates(rng, dates["vax1_earliest"], "2021-09-30", len(vaccinated))
+    dose_2 = dose_1 + rng.integers(56, 85, len(vaccinated)).astype("timedelta64[D]")
+    dose_3 = dose_2 + rng.integers(180, 241, len(vaccinated)).astype("timedelta64[D]")
+    # Products as indexes into vaccine_products (Pfizer, AstraZeneca, Moderna)
+    first_product = rng.choice(3, len(vaccinated), p=[0.45, 0.45, 0.1])
+    second_product = np.where(rng.random(len(vaccinated)) < 0.95, first_product, 0)
+    third_product = rng.choice([0, 2], len(vaccinated), p=[0.7, 0.3])
+    doses = [
+        (np.ones(len(vaccinated), dtype=bool), dose_1, first_product),
+        (rng.random(len(vaccinated)) < 0.9, dose_2, second_product),
+        (rng.random(len(vaccinated)) < 0.7, dose_3, third_product),
+    ]
+    patient_id = np.concatenate([vaccinated[given] for given, _, _ in doses])
+    product = np.concatenate([product[given] for given, _, product in doses])
+    writer.write("vaccinations", dict(
+        patient_id=patient_id,
+        vaccination_id=np.arange(1, len(patient_id) + 1),
+        date=np.concatenate([date[given] for given, date, _ in doses]),
+        target_disease=np.full(len(patient_id), "SARS-2 CORONAVIRUS"),
+        product_name=pa.array(list(vaccine_products.values())).take(pa.array(product)),
+    ))
+
+    for tested in background_patients(rng, patients, 1.0):
+        writer.write("sgss_covid_all_tests", dict(
+            patient_id=tested,
+            specimen_taken_date=random_dates(rng, dates["pandemic_start"], dates["lcd_date"], len(tested)),
+            is_positive=rng.random(len(tested)) < 0.25,
+        ))
+
+    for booked in background_patients(rng, patients, 4.0):
+        start_date = random_dates(rng, "2018-01-01", dates["lcd_date"], len(booked))
+        writer.write("appointments", dict(
+            patient_id=booked,
+            booked_date=start_date - rng.integers(0, 29, len(booked)).astype("timedelta64[D]"),
+            start_date=start_date,
+            seen_date=start_date,
+            status=take_codes(rng, appointment_statuses, len(booked)),
+        ))
+
+def timed(step, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print(f"  {step:<10} {time.perf_counter() - start:6.1f} s")
+    return result
+
+def generate(patients, output, seed=1, overrides=None, follow_up_share=0.5):
+    with open(STUDY_DATES_PATH) as f:
+        dates = json.load(f)
+    rng = np.random.default_rng(seed)
+    codes = read_codelists()
+    prevalence = codelist_prevalence(codes, overrides or {})
+
+    os.makedirs(output, exist_ok=True)
+    writer = TableWriter(output)
+    date_of_birth, death_date = timed("patients", generate_patients, rng, writer, patients, dates)
+    background_icd10 = timed(
+        "events", generate_events, rng, writer, patients, dates, date_of_birth, codes, prevalence, follow_up_share
+    )
+    timed("deaths", generate_deaths, rng, writer, patients, dates, death_date, codes, background_icd10)
+    timed("covid", generate_covid, rng, writer, patients, dates)
+    writer.close()
+
+    for table, rows in sorted(writer.rows.items()):
+        print(f"  {table:<36} {rows:>12,} rows")
+    return writer.rows
+
+def parse_prevalence(value):
+    name, _, prevalence = value.partition("=")
+    return name, float(prevalence)
+
+def main():
+    parser = ArgumentParser(description="Generate synthetic TPP tables with codes drawn from the project's codelists")
+    parser.add_argument("--patients", type=int, default=1_000_000)
+    parser.add_argument("--output", required=True, help="directory for the Parquet files")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--prevalence", type=parse_prevalence, action="append", default=[], metavar="CODELIST=SHARE")
+    parser.add_argument("--config", help="JSON file with the prevalence of each codelist")
+    parser.add_argument("--follow-up-share", type=float, default=0.5, help="share of events from the pandemic start")
+    args = parser.parse_args()
+
+    overrides = {}
+    if args.config:
+        with open(args.config) as f:
+            overrides.update(json.load(f))
+    overrides.update(args.prevalence)
+    unknown = set(overrides) - set(codelists._sources)
+    if unknown:
+        parser.error(f"unknown codelists: {', '.join(sorted(unknown))}")
+
+    start = time.perf_counter()
+    generate(args.patients, args.output, args.seed, overrides, args.follow_up_share)
+    print(f"Generated {args.patients:,} patients in {args.output} in {time.perf_counter() - start:.1f} s")
+
+if __name__ == "__main__":
+    main()
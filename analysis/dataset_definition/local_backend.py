@@ -0,0 +1,167 @@
+# Local stand-in for the TPP backend
+#
+# Loads synthetic data for the TPP tables used by the dataset definitions into a SQLite database, and
+# runs a dataset definition against it with ehrQL's SQLite query engine. Without --backend, ehrQL
+# reads each table from the database table of the same name (e.g. clinical_events), so the database
+# has one table per ehrQL table with the ehrQL column names. This lets the SQL that ehrQL generates
+# for the definitions be run and timed at a realistic scale (1M-10M patients) before submitting jobs.
+#
+# Each table is read from <data>/<table>.parquet (or .arrow), with the ehrQL column names and types,
+# as written by generate_synthetic_data.py.
+# Run from the repository root, e.g.:
+#   python analysis/dataset_definition/local_backend.py load --data synthetic --database local_tpp.db
+#   python analysis/dataset_definition/local_backend.py run dataset_definition_prevax.py \
+#     --database local_tpp.db --output input_prevax.arrow -- --inline-dates
+
+import os
+import shlex
+import sqlite3
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import date
+
+DEFINITION_DIR = "analysis/dataset_definition"
+
+# TPP tables used by the dataset definitions
+tables = [
+    "patients",
+    "addresses",
+    "practice_registrations",
+    "clinical_events",
+    "medications",
+    "apcs",
+    "emergency_care_attendances",
+    "ons_deaths",
+    "vaccinations",
+    "sgss_covid_all_tests",
+    "appointments",
+    "ethnicity_from_sus",
+    "occupation_on_covid_vaccine_record",
+]
+
+BATCH_SIZE = 100_000
+
+# Reading tables --------------------------------------------------------------------------------
+
+def find_table_file(data, table):
+    for extension in [".parquet", ".arrow"]:
+        path = os.path.join(data, table + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+def sqlite_type(arrow_type):
+    import pyarrow as pa
+
+    if pa.types.is_boolean(arrow_type) or pa.types.is_integer(arrow_type):
+        return "INTEGER"
+    if pa.types.is_floating(arrow_type):
+        return "REAL"
+    if pa.types.is_date(arrow_type):
+        return "DATE"
+    return "TEXT"
+
+def read_batches(path):
+    # Yields the column names and SQLite types, then lists of rows
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        source = pq.ParquetFile(path)
+        schema, batches = source.schema_arrow, source.iter_batches(batch_size=BATCH_SIZE)
+    else:
+        import pyarrow.feather as feather
+
+        table = feather.read_table(path)
+        schema, batches = table.schema, table.to_batches(max_chunksize=BATCH_SIZE)
+
+    yield [(field.name, sqlite_type(field.type)) for field in schema]
+    for batch in batches:
+        columns = [
+            [value.isoformat() if isinstance(value, date) else value for value in column.to_pylist()]
+            for column in batch.columns
+        ]
+        yield list(zip(*columns))
+
+# Loading ---------------------------------------------------------------------------------------
+
+def load_table(conn, table, path):
+    batches = read_batches(path)
+    columns = next(batches)
+    conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.execute(f"CREATE TABLE {table} ({', '.join(f'{name} {type_}' for name, type_ in columns)})")
+    insert = f"INSERT INTO {table} VALUES ({', '.join(['?'] * len(columns))})"
+    rows = 0
+    for batch in batches:
+        conn.executemany(insert, batch)
+        rows += len(batch)
+    conn.execute(f"CREATE INDEX {table}_patient_id ON {table} (patient_id)")
+    conn.commit()
+    return rows
+
+def load_database(data, database):
+    conn = sqlite3.connect(database)
+    # The database is rebuilt from the synthetic data if anything goes wrong, so skip the journal
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    missing = [table for table in tables if find_table_file(data, table) is None]
+    if missing:
+        sys.exit(f"No data in {data} for: {', '.join(missing)}")
+
+    for table in tables:
+        start = time.perf_counter()
+        rows = load_table(conn, table, find_table_file(data, table))
+        print(f"  {table:<36} {rows:>12,} rows in {time.perf_counter() - start:6.1f} s")
+    conn.execute("ANALYZE")
+    conn.close()
+
+# Running ---------------------------------------------------------------------------------------
+
+def run_definition(definition, database, output, user_args, ehrql="ehrql"):
+    command = [
+        *shlex.split(ehrql),
+        "generate-dataset",
+        f"{DEFINITION_DIR}/{definition}",
+        "--output",
+        output,
+        "--dsn",
+        f"sqlite:///{os.path.abspath(database)}",
+        "--query-engine",
+        "sqlite",
+    ]
+    if user_args:
+        command += ["--", *user_args]
+    start = time.perf_counter()
+    subprocess.run(command, check=True)
+    seconds = time.perf_counter() - start
+    print(f"Ran {definition} against {database} in {seconds:.1f} s")
+    return seconds
+
+def main():
+    parser = ArgumentParser(description="Load synthetic TPP tables into SQLite and run dataset definitions against them")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load_parser = subparsers.add_parser("load")
+    load_parser.add_argument("--data", required=True, help="directory with one file per table")
+    load_parser.add_argument("--database", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("definition", help=f"dataset definition in {DEFINITION_DIR}")
+    run_parser.add_argument("--database", required=True)
+    run_parser.add_argument("--output", required=True)
+    run_parser.add_argument("--ehrql", default="ehrql", help="command that runs ehrQL")
+    run_parser.add_argument("user_args", nargs="*", help="arguments of the dataset definition (after --)")
+
+    args = parser.parse_args()
+
+    if args.command == "load":
+        start = time.perf_counter()
+        load_database(args.data, args.database)
+        print(f"Loaded {args.database} in {time.perf_counter() - start:.1f} s")
+    else:
+        run_definition(args.definition, args.database, args.output, args.user_args, args.ehrql)
+
+if __name__ == "__main__":
+    main()
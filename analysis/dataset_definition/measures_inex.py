@@ -0,0 +1,66 @@
+from ehrql import (
+    create_measures,
+)
+# Bring table definitions from the TPP backend 
+from ehrql.tables.tpp import ( 
+    patients, 
+)
+
+from datetime import date
+
+from dataset_definition_cohorts import (
+    get_cohort_dates,
+    get_shared_variables,
+    parse_cohort_args,
+)
+
+from variable_helper_functions import all_of
+
+# Count the patients remaining after each inclusion criterion applied to all cohorts, i.e. the flow
+# that fn-inex.R produces, for extractions run with --restrict-population, e.g.
+# ehrql generate-measures measures_inex.py --output output/dataset_definition/inex_flow_vax.csv -- --cohort vax
+
+args = parse_cohort_args()
+cohort = args.cohort
+
+# extract index dates for the cohort from index_dates.csv (or compute them inline with --inline-dates)
+
+cohort_dates = get_cohort_dates(inline_dates=args.inline_dates)
+
+index_date = cohort_dates[f"index_{cohort}"]
+end_date_exposure = cohort_dates[f"end_{cohort}_exposure"]
+end_date_outcome = cohort_dates[f"end_{cohort}_outcome"]
+
+from variables_cohorts import generate_variables, generate_inex_criteria
+
+variables = generate_variables(
+    index_date, end_date_exposure, end_date_outcome,
+    get_shared_variables(args.inline_dates), cohort_dates[f"cens_date_dereg_{cohort}"]
+)
+
+inex_criteria = generate_inex_criteria(variables, index_date, end_date_exposure)
+
+# Create measures: one per criterion, counting patients who meet it and every criterion before it.
+# The denominator is the unrestricted population, i.e. the Input row of the flow table
+
+measures = create_measures()
+
+measures.configure_dummy_data(population_size=5000)
+
+# The counts are redacted (midpoint 6 rounding) by dataset_clean.R, as for the flow computed in R
+measures.configure_disclosure_control(enabled=False)
+
+population = patients.date_of_birth.is_not_null()
+
+# The criteria use patient-level index dates, so a single nominal interval is enough
+intervals = [(date(2020, 1, 1), date(2020, 1, 1))]
+
+included = []
+for number, (name, condition) in enumerate(inex_criteria.items(), start=1):
+    included.append(condition)
+    measures.define_measure(
+        name=f"inex_{number:02d}_{name}",
+        numerator=all_of(included),
+        denominator=population,
+        intervals=intervals,
+    )
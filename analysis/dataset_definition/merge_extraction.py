@@ -0,0 +1,87 @@
+# Merge a re-extraction of changed variables into the previous cohort extraction
+#
+# generate_input_{cohort}_changed extracts only the variables listed in lib/changed_variables_{cohort}.json
+# (see variables_fingerprint.py). This script replaces (or adds) those columns in the previous
+# extraction, matching rows on patient_id, and drops the variables that no longer exist. The two
+# extractions must have the same patients and index dates; otherwise the full extraction must be re-run.
+#
+#   python analysis/dataset_definition/merge_extraction.py \
+#     --previous output/dataset_definition/input_prevax.arrow \
+#     --changed output/dataset_definition/input_prevax_changed.arrow \
+#     --variables lib/changed_variables_prevax.json \
+#     --output output/dataset_definition/input_prevax_merged.arrow
+
+import json
+import sys
+from argparse import ArgumentParser
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import feather
+
+# Columns that must be identical in both extractions for the merge to be valid
+key_columns = ["index_date", "end_date_exposure", "end_date_outcome"]
+
+# Extractions are merged as Arrow tables, so the typed columns of an Arrow extraction (nullable
+# integers and booleans, dates, dictionaries) are written back with the same types
+def read_extraction(path):
+    if path.endswith(".arrow"):
+        return feather.read_table(path)
+    # Keep the CSV values exactly as written by ehrQL
+    return pa.Table.from_pandas(pd.read_csv(path, dtype=str, keep_default_na=False), preserve_index=False)
+
+def write_extraction(table, path):
+    if path.endswith(".arrow"):
+        feather.write_feather(table, path)
+    else:
+        table.to_pandas().to_csv(path, index=False)
+
+def merge_extractions(previous, changed, drop=()):
+    previous_ids = previous["patient_id"]
+    changed_ids = changed["patient_id"]
+    if not pc.take(previous_ids, pc.sort_indices(previous_ids)).equals(
+        pc.take(changed_ids, pc.sort_indices(changed_ids))
+    ):
+        sys.exit("The extractions have different patients; re-run the full extraction")
+
+    # Rows of the re-extraction in the order of the previous extraction
+    changed = changed.take(pc.index_in(previous_ids, value_set=pa.concat_arrays(changed_ids.chunks)))
+    for column in key_columns:
+        if column in previous.column_names and column in changed.column_names and not previous[column].equals(changed[column]):
+            sys.exit(f"{column} differs between the extractions; re-run the full extraction")
+
+    merged = previous.select([column for column in previous.column_names if column not in drop])
+    for column in changed.column_names:
+        if column == "patient_id":
+            continue
+        if column in merged.column_names:
+            merged = merged.set_column(merged.column_names.index(column), column, changed[column])
+        else:
+            merged = merged.append_column(column, changed[column])
+
+    return merged
+
+def main():
+    parser = ArgumentParser(description="Merge re-extracted variables into the previous cohort extraction")
+    parser.add_argument("--previous", required=True)
+    parser.add_argument("--changed", required=True)
+    parser.add_argument("--variables", required=True, help="JSON file from variables_fingerprint.py")
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    with open(args.variables) as f:
+        drop = json.load(f).get("drop", [])
+
+    previous = read_extraction(args.previous)
+    changed = read_extraction(args.changed)
+    merged = merge_extractions(previous, changed, drop)
+    write_extraction(merged, args.output)
+
+    replaced = [column for column in changed.column_names if column in previous.column_names and column != "patient_id"]
+    added = [column for column in changed.column_names if column not in previous.column_names]
+    print(f"Merged {changed.num_columns - 1} columns ({len(replaced)} replaced, {len(added)} added), dropped {len(drop)}")
+    print(f"Wrote {merged.num_rows} rows and {merged.num_columns} columns to {args.output}")
+
+if __name__ == "__main__":
+    main()
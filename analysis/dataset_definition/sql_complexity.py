@@ -0,0 +1,251 @@
+# Complexity of the SQL generated for the dataset definitions
+#
+# Compiles each dataset definition offline with ehrql dump-dataset-sql (no database is needed) and
+# counts what drives the cost of the query: temporary tables, joins, window functions (OVER),
+# predicates (WHERE/ON/HAVING conditions and the AND/OR between them) and CASE branches. The counts are
+# reported for the whole definition and for each variable or section of variables on its own (through
+# the wrapper definition of benchmark_variables.py), net of the population and index dates.
+#
+# With --budget, the counts are checked against a JSON budget (e.g. lib/sql_budget.json):
+#   {
+#     "by": "variable",
+#     "default_unit": {"temporary_tables": 4, "joins": 8, ...},
+#     "definitions": {
+#       "dataset_definition_prevax.py": {
+#         "total": {"temporary_tables": 150, "joins": 420, ...},
+#         "units": {"out_date_dem_alz": {"temporary_tables": 6, ...}, ...}
+#       }
+#     }
+#   }
+# A definition over its total, or a variable (or section) over its own budget or, if it has none,
+# over default_unit, fails the check and the script exits with 1. --update-budget records the current
+# counts (plus --headroom) as the budget, so that a new variable that doubles the cost of the query
+# is caught in review rather than on the server. No budget is recorded in the repository yet, and no
+# project action or CI step runs --budget, so nothing is enforced: record one with --update-budget
+# where ehrQL is installed, commit it, and add the --budget check to project.yaml or CI.
+#
+# The arguments after -- are those of the cohort definitions (dataset_definition_cohorts.py, e.g.
+# --inline-dates); they are only passed to the definitions built from it, and
+# dataset_definition_dates.py, which takes no arguments, is compiled without them.
+#
+# Run from the repository root, e.g.:
+#   python analysis/dataset_definition/sql_complexity.py --output sql_complexity.json -- --inline-dates
+#   python analysis/dataset_definition/sql_complexity.py --definition dataset_definition_prevax.py --by variable \
+#     --budget lib/sql_budget.json -- --inline-dates
+
+import csv
+import glob
+import json
+import math
+import os
+import re
+import shlex
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+from benchmark_variables import (
+    benchmark_units,
+    generated_sql,
+    load_definition_variables,
+    write_wrapper,
+)
+from local_backend import DEFINITION_DIR
+
+# Counts ----------------------------------------------------------------------------------------
+
+metrics = ["temporary_tables", "joins", "window_functions", "predicates", "case_branches", "sql_bytes"]
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_comment = re.compile(r"--[^\n]*")
+
+patterns = dict(
+    # Tables the query creates: SELECT ... INTO #tmp (MSSQL) or CREATE [TEMPORARY] TABLE (other engines)
+    temporary_tables=re.compile(r"(?:(?<!INSERT )\bINTO|\bCREATE\s+(?:TEMPORARY\s+)?TABLE)\s+\[?(#*\w+)", re.IGNORECASE),
+    joins=re.compile(r"\bJOIN\b", re.IGNORECASE),
+    window_functions=re.compile(r"\bOVER\s*\(", re.IGNORECASE),
+    clauses=re.compile(r"\b(?:WHERE|ON|HAVING)\b", re.IGNORECASE),
+    connectives=re.compile(r"\b(?:AND|OR)\b", re.IGNORECASE),
+    between=re.compile(r"\bBETWEEN\b", re.IGNORECASE),
+    case_branches=re.compile(r"\bWHEN\b", re.IGNORECASE),
+)
+
+def count_sql(sql):
+    # Codes and dates in string literals (e.g. codelists in IN (...)) are not SQL structure
+    text = _comment.sub("", _string_literal.sub("''", sql))
+    return dict(
+        temporary_tables=len(set(patterns["temporary_tables"].findall(text))),
+        joins=len(patterns["joins"].findall(text)),
+        window_functions=len(patterns["window_functions"].findall(text)),
+        # Each clause has one condition more than its connectives; the AND of BETWEEN is not a connective
+        predicates=(
+            len(patterns["clauses"].findall(text))
+            + len(patterns["connectives"].findall(text))
+            - len(patterns["between"].findall(text))
+        ),
+        case_branches=len(patterns["case_branches"].findall(text)),
+        sql_bytes=len(sql.encode()),
+    )
+
+def net_counts(counts, base):
+    return {metric: counts[metric] - base[metric] for metric in metrics}
+
+def dump_sql(definition, user_args, backend, ehrql="ehrql", env=None):
+    command = [*shlex.split(ehrql), "dump-dataset-sql", definition, "--backend", backend]
+    if user_args:
+        command += ["--", *user_args]
+    return generated_sql(command, env or dict(os.environ)).decode()
+
+# Definitions -----------------------------------------------------------------------------------
+
+def find_definitions():
+    # Dataset definitions assign a module-level dataset (dataset_definition_cohorts.py only has helpers)
+    definitions = []
+    for path in sorted(glob.glob(os.path.join(DEFINITION_DIR, "dataset_definition_*.py"))):
+        with open(path) as f:
+            if re.search(r"^dataset = ", f.read(), re.MULTILINE):
+                definitions.append(os.path.basename(path))
+    return definitions
+
+def takes_user_args(definition):
+    # The cohort definitions parse their arguments in dataset_definition_cohorts.py
+    with open(os.path.join(DEFINITION_DIR, definition)) as f:
+        return re.search(r"^from dataset_definition_cohorts import", f.read(), re.MULTILINE) is not None
+
+def definition_complexity(definition, user_args, by, backend, ehrql="ehrql"):
+    total = count_sql(dump_sql(os.path.join(DEFINITION_DIR, definition), user_args, backend, ehrql))
+    units = {}
+    if by != "definition":
+        unit_variables = benchmark_units(load_definition_variables(definition, user_args), by)
+        with tempfile.TemporaryDirectory() as tmp:
+            wrapper = write_wrapper(definition, tmp)
+
+            def unit_counts(variables):
+                env = dict(os.environ, BENCHMARK_VARIABLES=json.dumps(variables))
+                return count_sql(dump_sql(wrapper, user_args, backend, ehrql, env))
+
+            base = unit_counts([])
+            for unit, variables in unit_variables.items():
+                units[unit] = dict(variables=variables, **net_counts(unit_counts(variables), base))
+    return dict(total=total, units=units)
+
+# Budget ----------------------------------------------------------------------------------------
+
+def over_budget(counts, budget):
+    return [
+        f"{metric} {counts[metric]} > {budget[metric]}"
+        for metric in metrics
+        if metric in budget and counts[metric] > budget[metric]
+    ]
+
+def check_budget(report, budget, by):
+    # The unit budgets are for variables or for sections (as recorded), so only the totals are checked
+    # against a budget recorded with the other
+    check_units = budget.get("by", by) == by
+    failures = []
+    for definition, complexity in report.items():
+        definition_budget = budget.get("definitions", {}).get(definition, {})
+        for problem in over_budget(complexity["total"], definition_budget.get("total", {})):
+            failures.append(f"{definition}: {problem}")
+        for unit, counts in complexity["units"].items() if check_units else []:
+            unit_budget = definition_budget.get("units", {}).get(unit, budget.get("default_unit", {}))
+            for problem in over_budget(counts, unit_budget):
+                failures.append(f"{definition} {unit}: {problem}")
+    return failures
+
+def with_headroom(counts, headroom):
+    return {metric: math.ceil(counts[metric] * (1 + headroom)) for metric in metrics}
+
+def update_budget(budget, report, headroom, by):
+    budget["by"] = by
+    definitions = budget.setdefault("definitions", {})
+    for definition, complexity in report.items():
+        definitions[definition] = dict(
+            total=with_headroom(complexity["total"], headroom),
+            units={unit: with_headroom(counts, headroom) for unit, counts in complexity["units"].items()},
+        )
+    # A new variable may cost as much as the costliest variable now, but no more
+    if "default_unit" not in budget:
+        units = [counts for complexity in report.values() for counts in complexity["units"].values()]
+        if units:
+            budget["default_unit"] = with_headroom(
+                {metric: max(counts[metric] for counts in units) for metric in metrics}, headroom
+            )
+    return budget
+
+# Report ----------------------------------------------------------------------------------------
+
+def write_report(report, output):
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    with open(os.path.splitext(output)[0] + ".csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["definition", "unit", *metrics])
+        for definition, complexity in report.items():
+            writer.writerow([definition, "total", *(complexity["total"][metric] for metric in metrics)])
+            for unit, counts in complexity["units"].items():
+                writer.writerow([definition, unit, *(counts[metric] for metric in metrics)])
+
+def print_report(report):
+    header = "".join(f"{metric.replace('_', ' '):>18}" for metric in metrics)
+    for definition, complexity in report.items():
+        print(f"\n{definition:<40}{header}")
+        print(f"  {'total':<38}" + "".join(f"{complexity['total'][metric]:>18,}" for metric in metrics))
+        # Units with the most SQL first
+        for unit, counts in sorted(complexity["units"].items(), key=lambda item: -item[1]["sql_bytes"]):
+            print(f"  {unit:<38}" + "".join(f"{counts[metric]:>18,}" for metric in metrics))
+
+# Main ------------------------------------------------------------------------------------------
+
+def main():
+    parser = ArgumentParser(description="Count temporary tables, joins, window functions and predicates in the generated SQL")
+    parser.add_argument(
+        "--definition", action="append", dest="definitions", help=f"dataset definition in {DEFINITION_DIR} (default: all)"
+    )
+    parser.add_argument("--by", choices=["definition", "variable", "section"], default="section")
+    parser.add_argument("--backend", default="tpp", help="ehrQL backend whose SQL is generated")
+    parser.add_argument("--ehrql", default="ehrql", help="command that runs ehrQL")
+    parser.add_argument("--output", help="JSON report (and a CSV copy)")
+    parser.add_argument("--budget", help="JSON budget to check the counts against")
+    parser.add_argument("--update-budget", action="store_true", help="record the current counts as the budget")
+    parser.add_argument("--headroom", type=float, default=0.1, help="allowance over the current counts when updating")
+    parser.add_argument("user_args", nargs="*", help="arguments of the cohort definitions (after --)")
+    args = parser.parse_args()
+
+    report = {}
+    for definition in args.definitions or find_definitions():
+        user_args = args.user_args if takes_user_args(definition) else []
+        print(f"Compiling {definition}" + (" (without the arguments after --)" if args.user_args and not user_args else ""))
+        report[definition] = definition_complexity(definition, user_args, args.by, args.backend, args.ehrql)
+
+    print_report(report)
+    if args.output:
+        write_report(report, args.output)
+        print(f"Wrote {args.output}")
+
+    if args.budget is None:
+        return
+    try:
+        with open(args.budget) as f:
+            budget = json.load(f)
+    except FileNotFoundError:
+        if not args.update_budget:
+            sys.exit(f"No budget in {args.budget}; record one with --update-budget")
+        budget = {}
+
+    if args.update_budget:
+        with open(args.budget, "w") as f:
+            json.dump(update_budget(budget, report, args.headroom, args.by), f, indent=2)
+        print(f"Recorded the budget for {len(report)} definitions in {args.budget}")
+        return
+
+    failures = check_budget(report, budget, args.by)
+    if failures:
+        print(f"\nOver the SQL budget in {args.budget}:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print(f"\nWithin the SQL budget in {args.budget}")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import operator
-from ehrql import case, when
+from ehrql import case, days, minimum_of, when
 from functools import reduce # for function building, e.g. any_of
 from ehrql.tables.tpp import (
     addresses,
@@ -9,6 +9,9 @@ from ehrql.tables.tpp import (
     ethnicity_from_sus,
     medications, 
     ons_deaths,
+    practice_registrations,
+    sgss_covid_all_tests,
+    vaccinations,
 )
 
 def ever_matching_event_clinical_ctv3_before(codelist, start_date, where=True):
@@ -56,17 +59,35 @@ def last_matching_event_apc_before(codelist, start_date, only_prim_diagnoses=Fal
     return query.sort_by(apcs.admission_date).last_for_patient()
 
 # helper function
+# Combine conditions with OR as a balanced tree rather than a left-nested chain, so that n conditions
+# give a predicate of depth log2(n) instead of n (24 diagnosis columns: depth 5 rather than 23)
 def any_of(conditions):
-    return reduce(operator.or_, conditions)
+    conditions = list(conditions)
+    while len(conditions) > 1:
+        conditions = [reduce(operator.or_, conditions[i:i + 2]) for i in range(0, len(conditions), 2)]
+    return conditions[0]
+
+# As any_of, combining the conditions with AND
+def all_of(conditions):
+    conditions = list(conditions)
+    while len(conditions) > 1:
+        conditions = [reduce(operator.and_, conditions[i:i + 2]) for i in range(0, len(conditions), 2)]
+    return conditions[0]
+
+# Emergency care attendances record up to 24 SNOMED CT diagnoses in separate columns
+ec_diagnosis_columns = [f"diagnosis_{i:02d}" for i in range(1, 25)]
+
+# True for attendances with any diagnosis column in the codelist, as a balanced OR over the columns
+def ec_diagnosis_is_in(codelist, frame=emergency_care_attendances, columns=ec_diagnosis_columns):
+    return any_of(
+        getattr(frame, column_name).is_in(codelist)
+        for column_name in columns
+    )
 
 def last_matching_event_ec_snomed_before(codelist, start_date, where=True):
-    conditions = [
-        getattr(emergency_care_attendances, column_name).is_in(codelist)
-        for column_name in ([f"diagnosis_{i:02d}" for i in range(1, 25)])
-    ]
     return(
         emergency_care_attendances.where(where)
-        .where(any_of(conditions))
+        .where(ec_diagnosis_is_in(codelist))
         .where(emergency_care_attendances.arrival_date.is_before(start_date))
         .sort_by(emergency_care_attendances.arrival_date)
         .last_for_patient()
@@ -133,13 +154,9 @@ def first_matching_event_apc_between(codelist, start_date, end_date, only_prim_d
     return query.sort_by(apcs.admission_date).first_for_patient()
 
 def first_matching_event_ec_snomed_between(codelist, start_date, end_date, where=True):
-    conditions = [
-        getattr(emergency_care_attendances, column_name).is_in(codelist)
-        for column_name in ([f"diagnosis_{i:02d}" for i in range(1, 25)])
-    ]
     return(
         emergency_care_attendances.where(where)
-        .where(any_of(conditions))
+        .where(ec_diagnosis_is_in(codelist))
         .where(emergency_care_attendances.arrival_date.is_on_or_between(start_date, end_date))
         .sort_by(emergency_care_attendances.arrival_date)
         .first_for_patient()
@@ -150,8 +167,149 @@ def matching_death_between(codelist, start_date, end_date, where=True):
         ons_deaths.cause_of_death_is_in(codelist) & ons_deaths.date.is_on_or_between(start_date, end_date)
     )
 
+# Last event before start_date for each category in a dictionary of codelists: one
+# last_matching_event_clinical_snomed_before query per category, collected in a dictionary
+def last_matching_event_clinical_snomed_before_by_category(codelists, start_date, where=True):
+    return {
+        category: last_matching_event_clinical_snomed_before(codelist, start_date, where)
+        for category, codelist in codelists.items()
+    }
+
+# Medications on or between start_date and end_date for each category in a dictionary of codelists,
+# one frame per category. Returns the unsorted events for each category, so that narrower windows can
+# be taken from them
+def matching_meds_dmd_between_by_category(codelists, start_date, end_date, where=True):
+    return {
+        category: (
+            medications.where(where)
+            .where(medications.dmd_code.is_in(codelist))
+            .where(medications.date.is_on_or_between(start_date, end_date))
+        )
+        for category, codelist in codelists.items()
+    }
+
+# Dates of the first n vaccinations for each group in a dictionary of vaccination conditions (e.g.
+# all COVID-19 vaccines, each product), named vax_date_{group}_{dose}. Every group is taken from the
+# same frame of vaccinations on or after start_date; each dose is the first vaccination after the
+# previous dose, so same-day records count as one dose
+def vaccination_timeline(groups, start_date, doses=3):
+    vaccines = vaccinations.where(vaccinations.date.is_on_or_after(start_date))
+    timeline = {}
+    for group, condition in groups.items():
+        group_vaccines = vaccines.where(condition)
+        previous_date = None
+        for dose in range(1, doses + 1):
+            candidates = group_vaccines
+            if previous_date is not None:
+                candidates = group_vaccines.where(group_vaccines.date > previous_date)
+            previous_date = candidates.sort_by(candidates.date).first_for_patient().date
+            timeline[f"vax_date_{group}_{dose}"] = previous_date
+    return timeline
+
+# Registration-based variables for each index date in a dictionary of index dates: the first
+# deregistration on or after the index date (cens_date_dereg), registration spanning the reg_days
+# before it (inex_bin_6m_reg) and the region of the practice on it (strat_cat_region). The
+# deregistration dates are all taken from one frame of registrations with an end date
+def get_registration_variables(index_dates, reg_days=180):
+    ended_registrations = practice_registrations.where(practice_registrations.end_date.is_not_null())
+    registration_variables = {}
+    for name, index_date in index_dates.items():
+        registration_variables[name] = dict(
+            cens_date_dereg = (
+                ended_registrations.where(ended_registrations.end_date.is_on_or_after(index_date))
+                .sort_by(ended_registrations.end_date)
+                .first_for_patient()
+                .end_date
+            ),
+            inex_bin_6m_reg = practice_registrations.spanning(
+                index_date - days(reg_days), index_date
+            ).exists_for_patient(),
+            strat_cat_region = practice_registrations.for_patient_on(index_date).practice_nuts1_region_name,
+        )
+    return registration_variables
+
+# COVID-19 evidence from each source (positive SGSS tests, primary care codes, admissions and deaths),
+# each source filtered once up to the end of the exposure window. From these frames:
+#   first      - first evidence from each source on or between start_date and end_date
+#   exp_date   - first evidence from any source in the window
+#   history    - evidence from each source (except death) before start_date
+#   hosp_date  - first admission with COVID-19 as the primary diagnosis within 28 days of exp_date
+def get_covid_evidence(start_date, end_date, covid_codes, primary_care_codes):
+    tests = sgss_covid_all_tests.where(sgss_covid_all_tests.is_positive).where(
+        sgss_covid_all_tests.specimen_taken_date.is_on_or_before(end_date)
+    )
+    events = clinical_events.where(clinical_events.ctv3_code.is_in(primary_care_codes)).where(
+        clinical_events.date.is_on_or_before(end_date)
+    )
+    # Admissions run to 28 days after the window so that severity is taken from the same frame
+    admissions = apcs.where(
+        (apcs.primary_diagnosis.is_in(covid_codes)) | (apcs.secondary_diagnosis.is_in(covid_codes))
+    ).where(apcs.admission_date.is_on_or_before(end_date + days(28)))
+
+    first = dict(
+        sgss = tests.where(
+            tests.specimen_taken_date.is_on_or_between(start_date, end_date)
+        ).specimen_taken_date.minimum_for_patient(),
+        gp = events.where(
+            events.date.is_on_or_between(start_date, end_date)
+        ).date.minimum_for_patient(),
+        apc = admissions.where(
+            admissions.admission_date.is_on_or_between(start_date, end_date)
+        ).admission_date.minimum_for_patient(),
+        death = case(
+            when(matching_death_between(covid_codes, start_date, end_date)).then(ons_deaths.date)
+        ),
+    )
+    exp_date = minimum_of(*first.values())
+
+    history = dict(
+        sgss = tests.where(tests.specimen_taken_date.is_before(start_date)).exists_for_patient(),
+        gp = events.where(events.date.is_before(start_date)).exists_for_patient(),
+        apc = admissions.where(admissions.admission_date.is_before(start_date)).exists_for_patient(),
+    )
+
+    hosp_date = admissions.where(
+        admissions.primary_diagnosis.is_in(covid_codes) &
+        admissions.admission_date.is_on_or_between(exp_date, exp_date + days(28))
+    ).admission_date.minimum_for_patient()
+
+    return dict(first=first, exp_date=exp_date, history=history, hosp_date=hosp_date)
+
+# Ethnicity recorded in SUS, used where there is no ethnicity code in primary care. It does not
+# depend on the index date, so it can be extracted once and passed to get_latest_ethnicity
+def get_ethnicity_sus(grouping=6):
+    if grouping == 6:
+        ethnicity_sus = case(
+            when(ethnicity_from_sus.code.is_in(["A", "B", "C"])).then("White"),
+            when(ethnicity_from_sus.code.is_in(["D", "E", "F", "G"])).then("Mixed"),
+            when(ethnicity_from_sus.code.is_in(["H", "J", "K", "L"])).then("Asian"),
+            when(ethnicity_from_sus.code.is_in(["M", "N", "P"])).then("Black"),
+            when(ethnicity_from_sus.code.is_in(["R", "S"])).then("Other"),
+        )
+    elif grouping == 16:
+        ethnicity_sus = case(
+            when(ethnicity_from_sus.code == "A").then("White British"),
+            when(ethnicity_from_sus.code == "B").then("White Irish"),
+            when(ethnicity_from_sus.code == "C").then("Other White"),
+            when(ethnicity_from_sus.code == "D").then("White and Caribbean"),
+            when(ethnicity_from_sus.code == "E").then("White and African"),
+            when(ethnicity_from_sus.code == "F").then("White and Asian"),
+            when(ethnicity_from_sus.code == "G").then("Other Mixed"),
+            when(ethnicity_from_sus.code == "H").then("Indian"),
+            when(ethnicity_from_sus.code == "J").then("Pakistani"),
+            when(ethnicity_from_sus.code == "K").then("Bangladeshi"),
+            when(ethnicity_from_sus.code == "L").then("Other Asian"),
+            when(ethnicity_from_sus.code == "M").then("Caribbean"),
+            when(ethnicity_from_sus.code == "N").then("African"),
+            when(ethnicity_from_sus.code == "P").then("Other Black"),
+            when(ethnicity_from_sus.code == "R").then("Chinese"),
+            when(ethnicity_from_sus.code == "S").then("All other ethnic groups"),
+        )
+
+    return ethnicity_sus
+
 def get_latest_ethnicity(
-        index_date, codelist, grouping=6
+        index_date, codelist, grouping=6, ethnicity_sus=None
     ):
         latest_ethnicity_from_codes_category_num = (
             clinical_events.where(clinical_events.snomedct_code.is_in(codelist))
@@ -169,14 +327,6 @@ def get_latest_ethnicity(
                 when(latest_ethnicity_from_codes_category_num == "4").then("Black"), # Black or Black British
                 when(latest_ethnicity_from_codes_category_num == "5").then("Other"), # Chinese or Other Ethnic group
             )
-
-            ethnicity_sus = case(
-                when(ethnicity_from_sus.code.is_in(["A", "B", "C"])).then("White"),
-                when(ethnicity_from_sus.code.is_in(["D", "E", "F", "G"])).then("Mixed"),
-                when(ethnicity_from_sus.code.is_in(["H", "J", "K", "L"])).then("Asian"),
-                when(ethnicity_from_sus.code.is_in(["M", "N", "P"])).then("Black"),
-                when(ethnicity_from_sus.code.is_in(["R", "S"])).then("Other"),
-            )
         elif grouping == 16:
             latest_ethnicity_from_codes = case(
                 when(latest_ethnicity_from_codes_category_num == "1").then("White British"),
@@ -197,24 +347,8 @@ def get_latest_ethnicity(
                 when(latest_ethnicity_from_codes_category_num == "16").then("All other ethnic groups"),
             )
 
-            ethnicity_sus = case(
-                when(ethnicity_from_sus.code == "A").then("White British"),
-                when(ethnicity_from_sus.code == "B").then("White Irish"),
-                when(ethnicity_from_sus.code == "C").then("Other White"),
-                when(ethnicity_from_sus.code == "D").then("White and Caribbean"),
-                when(ethnicity_from_sus.code == "E").then("White and African"),
-                when(ethnicity_from_sus.code == "F").then("White and Asian"),
-                when(ethnicity_from_sus.code == "G").then("Other Mixed"),
-                when(ethnicity_from_sus.code == "H").then("Indian"),
-                when(ethnicity_from_sus.code == "J").then("Pakistani"),
-                when(ethnicity_from_sus.code == "K").then("Bangladeshi"),
-                when(ethnicity_from_sus.code == "L").then("Other Asian"),
-                when(ethnicity_from_sus.code == "M").then("Caribbean"),
-                when(ethnicity_from_sus.code == "N").then("African"),
-                when(ethnicity_from_sus.code == "P").then("Other Black"),
-                when(ethnicity_from_sus.code == "R").then("Chinese"),
-                when(ethnicity_from_sus.code == "S").then("All other ethnic groups"),
-            )
+        if ethnicity_sus is None:
+            ethnicity_sus = get_ethnicity_sus(grouping)
 
         ethnicity_combined = case(
             when(latest_ethnicity_from_codes.is_not_null()).then(
@@ -1,5 +1,4 @@
 from ehrql import (
-    days,
     case,
     claim_permissions,
     when,
@@ -8,19 +7,70 @@ from ehrql import (
 # Bring table definitions from the TPP backend 
 from ehrql.tables.tpp import ( 
     patients, 
-    practice_registrations, 
     addresses, 
-    appointments, 
-    occupation_on_covid_vaccine_record,
-    sgss_covid_all_tests,
-    ethnicity_from_sus,
-    apcs, 
-    clinical_events, 
     ons_deaths,
 )
 
-# Codelists from codelists.py (which pulls all variables from the codelist folder)
-from codelists import *
+# Codelists from codelists.py (only the codelists imported here are parsed)
+from codelists import (
+    covid_codes,
+    covid_primary_care_positive_test,
+    covid_primary_care_code,
+    covid_primary_care_sequalae,
+    ethnicity_snomed,
+    smoking_clear,
+    bmi_obesity_snomed,
+    bmi_obesity_icd10,
+    stroke_isch_snomed,
+    stroke_isch_icd10,
+    liver_disease_snomed,
+    liver_disease_icd10,
+    copd_ctv3,
+    copd_icd10,
+    ckd_snomed,
+    ckd_icd10,
+    cancer_snomed,
+    cancer_icd10,
+    hypertension_icd10,
+    hypertension_drugs_dmd,
+    hypertension_snomed,
+    diabetes_icd10,
+    diabetes_drugs_dmd,
+    diabetes_snomed,
+    depression_snomed,
+    depression_icd10,
+    ami_snomed,
+    ami_icd10,
+    ami_prior_icd10,
+    prostate_cancer_snomed,
+    prostate_cancer_icd10,
+    pregnancy_snomed,
+    cocp_dmd,
+    hrt_dmd,
+    cis_snomed,
+    dem_alz_snomed,
+    dem_vasc_snomed,
+    dem_lb_snomed,
+    dem_other_snomed,
+    dem_unspec_snomed,
+    migraine_snomed,
+    mnd_snomed,
+    ms_snomed,
+    park_snomed,
+    rls_snomed,
+    rsd_snomed,
+    dem_alz_icd10,
+    dem_vasc_icd10,
+    dem_other_icd10,
+    dem_unspec_icd10,
+    migraine_icd10,
+    mnd_icd10,
+    ms_icd10,
+    park_icd10,
+    rsd_icd10,
+    outcome_snomed,
+    outcome_icd10,
+)
 
 
 # Call functions from variable_helper_functions
@@ -29,6 +79,7 @@ from variable_helper_functions import (
     first_matching_event_clinical_snomed_between,
     first_matching_event_apc_between,
     matching_death_between,
+    get_covid_evidence,
     last_matching_event_clinical_ctv3_before,
     last_matching_event_clinical_snomed_before,
     last_matching_med_dmd_before,
@@ -36,23 +87,35 @@ from variable_helper_functions import (
     filter_codes_by_category,
     get_latest_ethnicity,
     get_imd,
+    get_registration_variables,
 )
 
+# Variables that do not depend on the index date
+from variables_shared import generate_shared_variables
+
 # Claim permissions to allow dataset definition to import tables in dummy data
-claim_permissions("sgss_covid_all_tests", "occupation_on_covid_vaccine_record")
+claim_permissions("sgss_covid_all_tests") # used by get_covid_evidence
 
 
-def generate_variables(index_date, end_date_exp, end_date_out):  
+def generate_variables(index_date, end_date_exp, end_date_out, shared_variables=None, cens_date_dereg=None):  
 
     ## Define individual variables first 
     ## Then define a dictionary with all exposures, outcomes, covariates, and other variables
 
+    ## Variables that do not depend on the index date (sex, year of birth, healthcare worker,
+    ## 2019 consultation rate, SUS ethnicity) are passed in from the shared extraction, or
+    ## generated here if they are not given
+    if shared_variables is None:
+        shared_variables = generate_shared_variables()
+
+    ## Registration-based variables (deregistration, 6 months registration, region) at the index date.
+    ## The deregistration date is also extracted at the dates stage, so it is reused when passed in
+    registration = get_registration_variables(dict(cohort=index_date))["cohort"]
+
     ## Inclusion/exclusion criteria------------------------------------------------------------------------
 
     ### Registered for a minimum of 6 months prior to index date
-    inex_bin_6m_reg = (practice_registrations.spanning(
-        index_date - days(180), index_date
-        )).exists_for_patient()
+    inex_bin_6m_reg = registration["inex_bin_6m_reg"]
 
     ### Alive on the index date
     inex_bin_alive = (((patients.date_of_death.is_null()) | (patients.date_of_death.is_after(index_date))) & 
@@ -61,61 +124,19 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     ## Censoring criteria----------------------------------------------------------------------------------
 
     ### Deregistered
-    cens_date_dereg = (
-        practice_registrations.where(practice_registrations.end_date.is_not_null())
-        .where(practice_registrations.end_date.is_on_or_after(index_date))
-        .sort_by(practice_registrations.end_date)
-        .first_for_patient()
-        .end_date
-    )
+    if cens_date_dereg is None:
+        cens_date_dereg = registration["cens_date_dereg"]
 
     ## Exposures-------------------------------------------------------------------------------------------
 
-    ### COVID-19
-    tmp_exp_date_covid_sgss = (
-        sgss_covid_all_tests.where(
-            sgss_covid_all_tests.specimen_taken_date.is_on_or_between(index_date, end_date_exp)
-        )
-        .where(sgss_covid_all_tests.is_positive)
-        .sort_by(sgss_covid_all_tests.specimen_taken_date)
-        .first_for_patient()
-        .specimen_taken_date
-    )
-    tmp_exp_date_covid_gp = (
-        clinical_events.where(
-            (clinical_events.ctv3_code.is_in(
-                covid_primary_care_code + 
-                covid_primary_care_positive_test +
-                covid_primary_care_sequalae)) &
-            clinical_events.date.is_on_or_between(index_date, end_date_exp)
-        )
-        .sort_by(clinical_events.date)
-        .first_for_patient()
-        .date
-    )
-    tmp_exp_date_covid_apc = (
-        apcs.where(
-            ((apcs.primary_diagnosis.is_in(covid_codes)) | 
-             (apcs.secondary_diagnosis.is_in(covid_codes))) & 
-            (apcs.admission_date.is_on_or_between(index_date, end_date_exp))
-        )
-        .sort_by(apcs.admission_date)
-        .first_for_patient()
-        .admission_date
-    )
-    tmp_exp_covid_death = matching_death_between(covid_codes, index_date, end_date_exp)
-    tmp_exp_date_death = ons_deaths.date
-    tmp_exp_date_covid_death = case(
-        when(tmp_exp_covid_death).then(tmp_exp_date_death)
-    )
-    
-    exp_date_covid = minimum_of(
-        tmp_exp_date_covid_sgss, 
-        tmp_exp_date_covid_gp,
-        tmp_exp_date_covid_apc,
-        tmp_exp_date_covid_death
+    ### COVID-19 (first evidence from SGSS, primary care, admissions or death in the exposure window)
+    covid_evidence = get_covid_evidence(
+        index_date, end_date_exp, covid_codes,
+        covid_primary_care_code + covid_primary_care_positive_test + covid_primary_care_sequalae
     )
 
+    exp_date_covid = covid_evidence["exp_date"]
+
     ## Quality assurance-----------------------------------------------------------------------------------
 
     ### Prostate cancer
@@ -134,7 +155,7 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     ).exists_for_patient()
 
     ### Year of birth
-    qa_num_birth_year = patients.date_of_birth.year
+    qa_num_birth_year = shared_variables["qa_num_birth_year"]
 
     ## COCP or heart medication
     qa_bin_hrtcocp = last_matching_med_dmd_before(
@@ -142,30 +163,31 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     ).exists_for_patient()
 
     ## Outcomes - Neurodegenerative Primary/Secondary/Death Codes -----------------------------------------
+
+    ### First primary care record of every outcome in the window, one query per outcome; the
+    ### composites below (any dementia, MS or MND, RLS or RSD) are minima of these dates
+    tmp_out_date_gp = {
+        category: first_matching_event_clinical_snomed_between(codelist, index_date, end_date_out).date
+        for category, codelist in outcome_snomed.items()
+    }
+
+    ### First admission in the window of every outcome, one query per outcome
+    tmp_out_date_apc = {
+        category: first_matching_event_apc_between(codelist, index_date, end_date_out).admission_date
+        for category, codelist in outcome_icd10.items()
+    }
     
     ### Dementias
 
     ### Dementia risk conditions (Cognitive Impairment)
-    tmp_out_date_cis_gp = (
-        first_matching_event_clinical_snomed_between(
-        cis_snomed, index_date, end_date_out  
-        ).date
-    )
+    tmp_out_date_cis_gp = tmp_out_date_gp["cis"]
 
     out_date_cis = tmp_out_date_cis_gp # no icd10
 
     ### Alzheimers
-    tmp_out_date_dem_alz_gp = (
-        first_matching_event_clinical_snomed_between(
-        dem_alz_snomed, index_date, end_date_out  
-        ).date
-    )
+    tmp_out_date_dem_alz_gp = tmp_out_date_gp["dem_alz"]
 
-    tmp_out_date_dem_alz_apc = (
-        first_matching_event_apc_between(
-        dem_alz_icd10, index_date, end_date_out 
-        ).admission_date
-    )
+    tmp_out_date_dem_alz_apc = tmp_out_date_apc["dem_alz"]
 
     tmp_out_date_dem_alz_death= case(
         when(
@@ -180,17 +202,9 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     )
 
     ### Vascular Dementia
-    tmp_out_date_dem_vasc_gp = (
-        first_matching_event_clinical_snomed_between(
-        dem_vasc_snomed, index_date, end_date_out  
-        ).date
-    )
+    tmp_out_date_dem_vasc_gp = tmp_out_date_gp["dem_vasc"]
 
-    tmp_out_date_dem_vasc_apc = (
-        first_matching_event_apc_between(
-        dem_vasc_icd10, index_date, end_date_out 
-        ).admission_date
-    )
+    tmp_out_date_dem_vasc_apc = tmp_out_date_apc["dem_vasc"]
 
     tmp_out_date_dem_vasc_death= case(
         when(
@@ -205,26 +219,14 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     )
 
     ### Lewy Body
-    tmp_out_date_dem_lb_gp = (
-        first_matching_event_clinical_snomed_between(
-        dem_lb_snomed, index_date, end_date_out  
-        ).date
-    )
+    tmp_out_date_dem_lb_gp = tmp_out_date_gp["dem_lb"]
 
     out_date_dem_lb=tmp_out_date_dem_lb_gp # no icd10
 
     ### Other Dementia 
-    tmp_out_date_dem_other_gp = (
-        first_matching_event_clinical_snomed_between(
-        dem_other_snomed, index_date, end_date_out  
-        ).date
-    )
+    tmp_out_date_dem_other_gp = tmp_out_date_gp["dem_other"]
 
-    tmp_out_date_dem_other_apc = (
-        first_matching_event_apc_between(
-        dem_other_icd10, index_date, end_date_out 
-        ).admission_date
-    )
+    tmp_out_date_dem_other_apc = tmp_out_date_apc["dem_other"]
 
     tmp_out_date_dem_other_death= case(
         when(
@@ -240,17 +242,9 @@ def generate_variables(index_date, end_date_exp, end_date_out):
 
 
     ### Unspecified Dementia
-    tmp_out_date_dem_unspec_gp = (
-        first_matching_event_clinical_snomed_between(
-        dem_unspec_snomed, index_date, end_date_out  
-        ).date
-    )
+    tmp_out_date_dem_unspec_gp = tmp_out_date_gp["dem_unspec"]
 
-    tmp_out_date_dem_unspec_apc = (
-        first_matching_event_apc_between(
-        dem_unspec_icd10, index_date, end_date_out 
-        ).admission_date
-    )
+    tmp_out_date_dem_unspec_apc = tmp_out_date_apc["dem_unspec"]
 
     tmp_out_date_dem_unspec_death= case(
         when(
@@ -265,33 +259,26 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     )
                 
     ### Any Dementia
-    tmp_out_date_dem_any_gp = (
-        first_matching_event_clinical_snomed_between(
-        dem_alz_snomed   +
-        dem_vasc_snomed  +
-        dem_lb_snomed    +
-        dem_other_snomed +
-        dem_unspec_snomed, index_date, end_date_out  
-        ).date
+    tmp_out_date_dem_any_gp = minimum_of(
+        tmp_out_date_dem_alz_gp,
+        tmp_out_date_dem_vasc_gp,
+        tmp_out_date_dem_lb_gp,
+        tmp_out_date_dem_other_gp,
+        tmp_out_date_dem_unspec_gp
     )
 
-    tmp_out_date_dem_any_apc = (
-        first_matching_event_apc_between(
-        dem_alz_icd10   +
-        dem_vasc_icd10  +
-        dem_other_icd10 +
-        dem_unspec_icd10, index_date, end_date_out 
-        ).admission_date
+    tmp_out_date_dem_any_apc = minimum_of(
+        tmp_out_date_dem_alz_apc,
+        tmp_out_date_dem_vasc_apc,
+        tmp_out_date_dem_other_apc,
+        tmp_out_date_dem_unspec_apc
     )
 
-    tmp_out_date_dem_any_death= case(
-        when(
-            matching_death_between(
-            dem_alz_icd10   +
-            dem_vasc_icd10  +
-            dem_other_icd10 +
-            dem_unspec_icd10, index_date, end_date_out)
-            ).then(ons_deaths.date)
+    tmp_out_date_dem_any_death = minimum_of(
+        tmp_out_date_dem_alz_death,
+        tmp_out_date_dem_vasc_death,
+        tmp_out_date_dem_other_death,
+        tmp_out_date_dem_unspec_death
     )
 
     out_date_dem_any=minimum_of(
@@ -302,17 +289,9 @@ def generate_variables(index_date, end_date_exp, end_date_out):
 
     ### Other neurodegenerative conditions (MND, MS)
     ## MND
-    tmp_out_date_mnd_gp= (
-        first_matching_event_clinical_snomed_between(
-        mnd_snomed, index_date, end_date_out 
-        ).date
-    )
+    tmp_out_date_mnd_gp = tmp_out_date_gp["mnd"]
 
-    tmp_out_date_mnd_apc= (
-        first_matching_event_apc_between(
-        mnd_icd10, index_date, end_date_out 
-        ).admission_date
-    )
+    tmp_out_date_mnd_apc = tmp_out_date_apc["mnd"]
 
     tmp_out_date_mnd_death= case(
         when(
@@ -327,17 +306,9 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     )
 
     ## MS
-    tmp_out_date_ms_gp= (
-        first_matching_event_clinical_snomed_between(
-        ms_snomed, index_date, end_date_out 
-        ).date
-    )
+    tmp_out_date_ms_gp = tmp_out_date_gp["ms"]
 
-    tmp_out_date_ms_apc= (
-        first_matching_event_apc_between(
-        ms_icd10, index_date, end_date_out 
-        ).admission_date
-    )
+    tmp_out_date_ms_apc = tmp_out_date_apc["ms"]
 
     tmp_out_date_ms_death= case(
         when(
@@ -372,17 +343,9 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     )
 
     ### Neurological condition (Migrane)
-    tmp_out_date_migraine_gp= (
-        first_matching_event_clinical_snomed_between(
-        migraine_snomed, index_date, end_date_out 
-        ).date
-    )
+    tmp_out_date_migraine_gp = tmp_out_date_gp["migraine"]
 
-    tmp_out_date_migraine_apc= (
-        first_matching_event_apc_between(
-        migraine_icd10, index_date, end_date_out 
-        ).admission_date
-    )
+    tmp_out_date_migraine_apc = tmp_out_date_apc["migraine"]
 
     tmp_out_date_migraine_death= case(
         when(
@@ -397,17 +360,9 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     )
 
     ### Parkinson’s disease
-    tmp_out_date_park_gp = (
-        first_matching_event_clinical_snomed_between(
-        park_snomed, index_date, end_date_out  
-        ).date
-    )
+    tmp_out_date_park_gp = tmp_out_date_gp["park"]
 
-    tmp_out_date_park_apc = (
-        first_matching_event_apc_between(
-        park_icd10, index_date, end_date_out  
-        ).admission_date
-    )
+    tmp_out_date_park_apc = tmp_out_date_apc["park"]
 
     tmp_out_date_park_death= case(
         when(
@@ -423,26 +378,14 @@ def generate_variables(index_date, end_date_exp, end_date_out):
 
     ### Parkinson’s risk conditions (restless leg syndrome and REM sleep disorder)
     ## RLS
-    tmp_out_date_rls_gp= (
-        first_matching_event_clinical_snomed_between(
-        rls_snomed, index_date, end_date_out 
-        ).date
-    )
+    tmp_out_date_rls_gp = tmp_out_date_gp["rls"]
 
     out_date_rls = tmp_out_date_rls_gp
 
     ## RSD
-    tmp_out_date_rsd_gp= (
-        first_matching_event_clinical_snomed_between(
-        rsd_snomed, index_date, end_date_out 
-        ).date
-    )
+    tmp_out_date_rsd_gp = tmp_out_date_gp["rsd"]
 
-    tmp_out_date_rsd_apc= (
-        first_matching_event_apc_between(
-        rsd_icd10, index_date, end_date_out 
-        ).admission_date
-    )
+    tmp_out_date_rsd_apc = tmp_out_date_apc["rsd"]
 
     tmp_out_date_rsd_death= case(
         when(
@@ -471,7 +414,7 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     ## Strata----------------------------------------------------------------------------------------------
 
     ### Region
-    strat_cat_region = practice_registrations.for_patient_on(index_date).practice_nuts1_region_name
+    strat_cat_region = registration["strat_cat_region"]
 
     ## Core covariates-------------------------------------------------------------------------------------
 
@@ -479,10 +422,13 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     cov_num_age = patients.age_on(index_date)
 
     ### Sex
-    cov_cat_sex = patients.sex
+    cov_cat_sex = shared_variables["cov_cat_sex"]
 
     ### Ethnicity
-    cov_cat_ethnicity = get_latest_ethnicity(index_date,ethnicity_snomed, grouping=6)
+    cov_cat_ethnicity = get_latest_ethnicity(
+        index_date, ethnicity_snomed, grouping=6,
+        ethnicity_sus=shared_variables["tmp_cov_cat_ethnicity_sus"]
+    )
 
     ### Deprivation
     cov_cat_imd = get_imd(index_date, groups=10, max_imd=32844)
@@ -511,26 +457,10 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     )
 
     ### Consultation rate in 2019
-    tmp_cov_num_consrate2019 = appointments.where(
-        appointments.status.is_in([
-            "Arrived",
-            "In Progress",
-            "Finished",
-            "Visit",
-            "Waiting",
-            "Patient Walked Out",
-            ]) & appointments.start_date.is_on_or_between("2019-01-01", "2019-12-31")
-            ).count_for_patient()    
-
-    cov_num_consrate2019 = case(
-        when(tmp_cov_num_consrate2019 <= 365).then(tmp_cov_num_consrate2019),
-        otherwise=365,
-    )
+    cov_num_consrate2019 = shared_variables["cov_num_consrate2019"]
 
     ### Healthcare worker
-    cov_bin_hcworker = occupation_on_covid_vaccine_record.where(
-        (occupation_on_covid_vaccine_record.is_healthcare_worker == True)
-    ).exists_for_patient()
+    cov_bin_hcworker = shared_variables["cov_bin_hcworker"]
 
     ### Dementia (A core protocol covariate, but not used in this protocol)
     # cov_bin_dementia = (
@@ -683,8 +613,7 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     cov_bin_migraine= (
         last_matching_event_clinical_snomed_before(
         migraine_snomed, index_date
-        )
-    .exists_for_patient() |
+        ).exists_for_patient() |
         (last_matching_event_apc_before(
         migraine_icd10, index_date
         ).exists_for_patient()) 
@@ -694,7 +623,7 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     cov_bin_mnd= (
         last_matching_event_clinical_snomed_before(
         mnd_snomed, index_date
-        ).exists_for_patient()   |
+        ).exists_for_patient() |
         (last_matching_event_apc_before(
         mnd_icd10, index_date
         ).exists_for_patient()) 
@@ -712,27 +641,14 @@ def generate_variables(index_date, end_date_exp, end_date_out):
 
     ## History of Parkinsons
     cov_bin_park= (
-        (last_matching_event_clinical_snomed_before(
+        last_matching_event_clinical_snomed_before(
         park_snomed, index_date
-        ).exists_for_patient()) |
+        ).exists_for_patient() |
         (last_matching_event_apc_before(
         park_icd10, index_date
         ).exists_for_patient()) 
     )
 
-    ## History of Parkinson's Risk (REM Sleep Disorder/Restless Leg syndrome)
-    cov_bin_parkrisk= (
-        (last_matching_event_clinical_snomed_before(
-        rls_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_clinical_snomed_before(
-        rsd_snomed,  index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-        rsd_icd10,  index_date
-        ).exists_for_patient()) 
-    )
-    
     ## History of Restless Leg syndrome
     cov_bin_rls= (
         (last_matching_event_clinical_snomed_before(
@@ -746,61 +662,31 @@ def generate_variables(index_date, end_date_exp, end_date_out):
         rsd_snomed,  index_date
         ).exists_for_patient()) |
         (last_matching_event_apc_before(
-        rsd_icd10,  index_date
+        rsd_icd10, index_date
         ).exists_for_patient()) 
     )
 
+    ## History of Parkinson's Risk (REM Sleep Disorder/Restless Leg syndrome)
+    cov_bin_parkrisk= (
+        cov_bin_rls | cov_bin_rsd
+    )
+
     ## Subgroups-------------------------------------------------------------------------------------------
 
     ### History of COVID-19
-    tmp_sub_bin_covidhistory_sgss = (
-        sgss_covid_all_tests.where(
-            sgss_covid_all_tests.specimen_taken_date.is_before(index_date)
-        )
-        .where(sgss_covid_all_tests.is_positive)
-        .exists_for_patient()
-    )
-    tmp_sub_bin_covidhistory_gp = (
-        clinical_events.where(
-            (clinical_events.ctv3_code.is_in(
-                covid_primary_care_code + 
-                covid_primary_care_positive_test + 
-                covid_primary_care_sequalae)) &
-            clinical_events.date.is_before(index_date)
-        )
-        .exists_for_patient()
-    )
-    tmp_sub_bin_covidhistory_apc = (
-        apcs.where(
-            ((apcs.primary_diagnosis.is_in(covid_codes)) | (apcs.secondary_diagnosis.is_in(covid_codes))) & 
-            (apcs.admission_date.is_before(index_date))
-        )
-        .exists_for_patient()
-    )
-
     sub_bin_covidhistory = (
-        tmp_sub_bin_covidhistory_sgss |
-        tmp_sub_bin_covidhistory_gp |
-        tmp_sub_bin_covidhistory_apc
+        covid_evidence["history"]["sgss"] |
+        covid_evidence["history"]["gp"] |
+        covid_evidence["history"]["apc"]
     )
 
-    ### COVID-19 severity
-    tmp_sub_date_covidhospital = (
-        apcs.where(
-            (apcs.primary_diagnosis.is_in(covid_codes)) & 
-            (apcs.admission_date.is_on_or_after(exp_date_covid))
-        )
-        .sort_by(apcs.admission_date)
-        .first_for_patient()
-        .admission_date
-    )
+    ### COVID-19 severity (hospitalised within 28 days of the exposure)
+    tmp_sub_date_covidhospital = covid_evidence["hosp_date"]
 
     sub_cat_covidhospital = case(
         when(
             (exp_date_covid.is_not_null()) &
-            (tmp_sub_date_covidhospital.is_not_null()) &
-            ((tmp_sub_date_covidhospital - exp_date_covid).days >= 0) &
-            ((tmp_sub_date_covidhospital - exp_date_covid).days < 29)
+            (tmp_sub_date_covidhospital.is_not_null())
             ).then("hospitalised"),
         when(exp_date_covid.is_not_null()).then("non_hospitalised"),
         when(exp_date_covid.is_null()).then("no_infection")
@@ -942,3 +828,31 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     ) 
     
     return dynamic_variables
+
+
+# Inclusion criteria applied to all cohorts, in the order of inex() in fn-inex.R. Each criterion is
+# named so that the flow counts can be matched to their descriptions in fn-inex.R
+def generate_inex_criteria(variables, index_date, end_date_exp):
+
+    inex_criteria = dict(
+        alive      = variables["inex_bin_alive"],
+        age_min    = variables["cov_num_age"] >= 18,
+        age_max    = variables["cov_num_age"] <= 110,
+        sex        = variables["cov_cat_sex"].is_in(["female", "male"]),
+        imd        = variables["cov_cat_imd"] != "unknown",
+        region     = variables["strat_cat_region"].is_in([
+            "East",
+            "East Midlands",
+            "London",
+            "North East",
+            "North West",
+            "South East",
+            "South West",
+            "West Midlands",
+            "Yorkshire and The Humber",
+        ]),
+        reg_6m     = variables["inex_bin_6m_reg"],
+        index_date = index_date <= end_date_exp,
+    )
+
+    return inex_criteria
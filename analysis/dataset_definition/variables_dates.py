@@ -3,28 +3,39 @@ from ehrql import (
     case,
     when,
     minimum_of,
+    maximum_of,
 )
 
 # Bring table definitions from the TPP backend 
 from ehrql.tables.tpp import ( 
     patients, 
-    vaccinations,
     ons_deaths,
 )
 
-# Codelists from codelists.py (which pulls all variables from the codelist folder)
+# Codelists from codelists.py (only the codelists imported here are parsed)
 
-from codelists import *
+from codelists import (
+    longres_primis,
+    jcvi_cev_primis,
+    jcvi_ar_primis,
+    jcvi_ar_primis_dmd,
+)
 
 from datetime import date
 
 # Call functions from variable_helper_functions
 from variable_helper_functions import (
-    last_matching_event_clinical_snomed_between,
     last_matching_event_clinical_snomed_before,
-    last_matching_med_dmd_between,
+    last_matching_event_clinical_snomed_before_by_category,
+    matching_meds_dmd_between_by_category,
+    vaccination_timeline,
+    get_registration_variables,
 )
 
+# COVID-19 vaccination groups and number of doses (shared with the index_dates reader in
+# dataset_definition_cohorts.py)
+from variables_shared import vax_doses, vax_groups
+
 # Define the study_dates dictionary 
 
 import json
@@ -40,6 +51,10 @@ pandemic_start = study_dates["pandemic_start"]  # rough start date for pandemic
 vax1_earliest = study_dates["vax1_earliest"]  # earliest expectation date for first vaccination
 vax2_earliest = study_dates["vax2_earliest"]  # earliest expectation date for 2nd vaccination
 vax3_earliest = study_dates["vax3_earliest"]  # earliest expectation date for 3rd vaccination
+delta_date = study_dates["delta_date"]
+omicron_date = study_dates["omicron_date"]
+all_eligible = study_dates["all_eligible"]  # all 18+ are eligible for vax on this date (protocol)
+lcd_date = study_dates["lcd_date"] # last import date
 
 # JCVI VARIABLES-------------------------------------------------------------------------------------------------------------------
 
@@ -49,6 +64,22 @@ vax_jcvi_age_1 = patients.age_on(ref_age_1)
 # Age on phase 2 reference date
 vax_jcvi_age_2 = patients.age_on(ref_age_2)
 
+# Last PRIMIS event of each codelist before each reference date, and the at-risk medications in the
+# 180 days before ref_ar (one query per codelist, as before). The windowed conditions below are
+# comparisons on these events
+
+jcvi_cev_events = last_matching_event_clinical_snomed_before_by_category(
+    jcvi_cev_primis, ref_cev
+)
+
+jcvi_ar_events = last_matching_event_clinical_snomed_before_by_category(
+    jcvi_ar_primis, ref_ar
+)
+
+jcvi_ar_meds = matching_meds_dmd_between_by_category(
+    jcvi_ar_primis_dmd, ref_ar - days(180), ref_ar - days(1)
+)
+
 # preg_group (ongoing pregnancy as of the ref_cev)------------------------------------------
 
     ## Derived variables
@@ -56,14 +87,14 @@ vax_jcvi_age_2 = patients.age_on(ref_age_2)
 cov_cat_sex = patients.sex  # this is required for preg_group variables
 
     ## Date of last pregnancy code in 36 weeks before ref_cev
-preg_36wks_date = last_matching_event_clinical_snomed_between(
-    preg_primis, ref_cev - days(252), ref_cev - days(1)
-).date
+preg_36wks_date = case(
+    when(jcvi_cev_events["preg"].date >= ref_cev - days(252)).then(jcvi_cev_events["preg"].date)
+)
 
     ## Date of last delivery code recorded in 36 weeks before elig_date
-pregdel_pre_date = last_matching_event_clinical_snomed_between(
-    pregdel_primis, ref_cev - days(252), ref_cev - days(1)
-).date
+pregdel_pre_date = case(
+    when(jcvi_cev_events["pregdel"].date >= ref_cev - days(252)).then(jcvi_cev_events["pregdel"].date)
+)
 
 preg_group = (
     (preg_36wks_date.is_not_null()) & 
@@ -79,19 +110,17 @@ preg_group = (
     ## Derived variables
 
     ## SHIELDED GROUP - first flag all patients with "high risk" codes
-severely_clinically_vulnerable = last_matching_event_clinical_snomed_before(
-    shield_primis, ref_cev
-).exists_for_patient()
+severely_clinically_vulnerable = jcvi_cev_events["shield"].exists_for_patient()
 
     ## Find date at which the high risk code was added
-severely_clinically_vulnerable_date = last_matching_event_clinical_snomed_before(
-    shield_primis, ref_cev
-).date
+severely_clinically_vulnerable_date = jcvi_cev_events["shield"].date
 
     ## NOT SHIELDED GROUP (medium and low risk) - only flag if later than 'shielded'
-less_vulnerable = last_matching_event_clinical_snomed_between(
-    nonshield_primis, severely_clinically_vulnerable_date + days(1), ref_cev - days(1)
-).exists_for_patient()
+    ## (False rather than NULL without a nonshield code, so that cev_group is True for those patients)
+less_vulnerable = (
+    jcvi_cev_events["nonshield"].date.is_on_or_after(severely_clinically_vulnerable_date + days(1))
+    .when_null_then(False)
+)
 
 cev_group = (
     severely_clinically_vulnerable & (less_vulnerable == False)
@@ -102,28 +131,24 @@ cev_group = (
 # asthma_group
     ## Derived variables for asthma_group
     ## Asthma Diagnosis codes
-astdx = last_matching_event_clinical_snomed_before(
-    ast_primis, ref_ar
-).exists_for_patient()
+astdx = jcvi_ar_events["ast"].exists_for_patient()
 
     ## Asthma Admission codes
-astadm = last_matching_event_clinical_snomed_before(
-    astadm_primis, ref_ar
-).exists_for_patient()
+astadm = jcvi_ar_events["astadm"].exists_for_patient()
 
     ## Asthma systemic steroid prescription code in month 1
-astrxm1 = last_matching_med_dmd_between(
-    astrx_primis, ref_ar - days(31), ref_ar - days(1)
+astrxm1 = jcvi_ar_meds["astrx"].where(
+    jcvi_ar_meds["astrx"].date.is_on_or_between(ref_ar - days(31), ref_ar - days(1))
 ).exists_for_patient()
 
     ## Asthma systemic steroid prescription code in month 2
-astrxm2 = last_matching_med_dmd_between(
-    astrx_primis, ref_ar - days(61), ref_ar - days(32)
+astrxm2 = jcvi_ar_meds["astrx"].where(
+    jcvi_ar_meds["astrx"].date.is_on_or_between(ref_ar - days(61), ref_ar - days(32))
 ).exists_for_patient()
 
     ## Asthma systemic steroid prescription code in month 3
-astrxm3 = last_matching_med_dmd_between(
-    astrx_primis, ref_ar - days(91), ref_ar - days(62)
+astrxm3 = jcvi_ar_meds["astrx"].where(
+    jcvi_ar_meds["astrx"].date.is_on_or_between(ref_ar - days(91), ref_ar - days(62))
 ).exists_for_patient()
 
 asthma_group = (
@@ -131,26 +156,18 @@ asthma_group = (
 )
 
 # resp_group (Chronic Respiratory Disease other than asthma)
-resp_group = last_matching_event_clinical_snomed_before(
-    resp_primis, ref_ar
-).exists_for_patient()
+resp_group = jcvi_ar_events["resp"].exists_for_patient()
 
 # cns_group (Chronic Neurological Disease including Significant Learning Disorder)
-cns_group = last_matching_event_clinical_snomed_before(
-    cns_primis, ref_ar
-).exists_for_patient()
+cns_group = jcvi_ar_events["cns"].exists_for_patient()
 
 # diab_group (Diabetes)
     ## Derived variables for diab_group (Diabetes)
     ## Diabetes diagnosis codes
-diab_date = last_matching_event_clinical_snomed_before(
-    diab_primis, ref_ar
-).date
+diab_date = jcvi_ar_events["diab"].date
 
     ## Diabetes resolved codes
-dmres_date = last_matching_event_clinical_snomed_before(
-    dmres_primis, ref_ar
-).date
+dmres_date = jcvi_ar_events["dmres"].date
 
 diab_group = (
     (dmres_date.is_null() & diab_date.is_not_null()) | (dmres_date < diab_date)
@@ -159,40 +176,28 @@ diab_group = (
 # sevment_group (severe mental illness codes)
     ## Derived variables for sevment_group (severe mental illness codes)
     ## Severe Mental Illness codes
-sev_mental_date = last_matching_event_clinical_snomed_before(
-    sev_mental_primis, ref_ar
-).date
+sev_mental_date = jcvi_ar_events["sev_mental"].date
 
     ## Remission codes relating to Severe Mental Illness
-smhres_date = last_matching_event_clinical_snomed_before(
-    smhres_primis, ref_ar
-).date
+smhres_date = jcvi_ar_events["smhres"].date
 
 sevment_group = (
     (smhres_date.is_null() & sev_mental_date.is_not_null()) | (smhres_date < sev_mental_date)
 )
 
 # chd_group (Chronic heart disease codes)
-chd_group = last_matching_event_clinical_snomed_before(
-    chd_primis, ref_ar
-).exists_for_patient()
+chd_group = jcvi_ar_events["chd"].exists_for_patient()
 
 # ckd_group (Chronic kidney disease diagnostic codes)
     ## Derived variables for ckd_group (Chronic kidney disease diagnostic codes)
     ## Chronic kidney disease codes - all stages
-ckd15_date = last_matching_event_clinical_snomed_before(
-    ckd15_primis, ref_ar
-).date
+ckd15_date = jcvi_ar_events["ckd15"].date
 
     ## Chronic kidney disease codes-stages 3 - 5
-ckd35_date = last_matching_event_clinical_snomed_before(
-    ckd35_primis, ref_ar
-).date
+ckd35_date = jcvi_ar_events["ckd35"].date
 
     ## Chronic kidney disease diagnostic codes
-ckd = last_matching_event_clinical_snomed_before(
-    ckd_primis, ref_ar
-).exists_for_patient()
+ckd = jcvi_ar_events["ckd"].exists_for_patient()
 
 ckd_group = (
     ckd | 
@@ -201,56 +206,40 @@ ckd_group = (
 )
 
 # cld_group (Chronic Liver disease codes)
-cld_group = last_matching_event_clinical_snomed_before(
-    cld_primis, ref_ar
-).exists_for_patient()
+cld_group = jcvi_ar_events["cld"].exists_for_patient()
 
 # immuno_group (immunosuppressed)
     ## Derived variables for immuno_group (immunosuppressed)
     ## Immunosuppression diagnosis codes
-immdx = last_matching_event_clinical_snomed_before(
-    immdx_primis, ref_ar
-).exists_for_patient()
+immdx = jcvi_ar_events["immdx"].exists_for_patient()
 
     ## Immunosuppression medication codes
-immrx = last_matching_med_dmd_between(
-    immrx_primis, ref_ar - days(180), ref_ar - days(1)
-).exists_for_patient()
+immrx = jcvi_ar_meds["immrx"].exists_for_patient()
 
 immuno_group = (immdx | immrx)
 
 
 # spln_group (Asplenia or Dysfunction of the Spleen codes)
-spln_group = last_matching_event_clinical_snomed_before(
-    spln_primis, ref_ar
-).exists_for_patient()
+spln_group = jcvi_ar_events["spln"].exists_for_patient()
 
 # learndis_group (Wider Learning Disability)
-learndis_group = last_matching_event_clinical_snomed_before(
-    learndis_primis, ref_ar
-).exists_for_patient()
+learndis_group = jcvi_ar_events["learndis"].exists_for_patient()
 
 # sevobese_group (Severe obesity)
     ## Derived variables for sevobese_group (Severe obesity)
     ## All BMI coded terms
-bmi_stage_date = last_matching_event_clinical_snomed_before(
-    bmi_stage_primis, ref_ar
-).date
+bmi_stage_date = jcvi_ar_events["bmi_stage"].date
 
-    ## Severe Obesity code recorded
-sev_obesity_date = last_matching_event_clinical_snomed_between(
-    sev_obesity_primis, bmi_stage_date, ref_ar - days(1)
-).date
+    ## Severe Obesity code recorded (on or after the last BMI stage code)
+sev_obesity_date = case(
+    when(jcvi_ar_events["sev_obesity"].date >= bmi_stage_date).then(jcvi_ar_events["sev_obesity"].date)
+)
 
     ## BMI_primis
-bmi_date = last_matching_event_clinical_snomed_before(
-    bmi_primis, ref_ar
-).date
+bmi_date = jcvi_ar_events["bmi"].date
 
     ## BMI value
-bmi_value_temp = last_matching_event_clinical_snomed_before(
-    bmi_primis, ref_ar
-).numeric_value
+bmi_value_temp = jcvi_ar_events["bmi"].numeric_value
 
 sevobese_group = (
     (sev_obesity_date.is_not_null() & bmi_date.is_null()) |
@@ -365,162 +354,114 @@ death_date = minimum_of(primary_care_death_date, ons_died_from_any_cause_date)
 
 # add vaccination dates----------------------------------------------------------------------------
 
-# COVID-19 Vaccination (identified by target diseases of the vaccination)
+# Dates of each dose (vax_date_covid_1, ..., vax_date_Moderna_3) from one shared frame of vaccinations
+vax_dates = vaccination_timeline(vax_groups, vax1_earliest, doses=vax_doses)
 
-vax_date_covid_1 = (
-    vaccinations.where(
-    vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"))
-    .where(vaccinations.date.is_on_or_after(vax1_earliest))
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date
-)
+vax_date_covid_1 = vax_dates["vax_date_covid_1"]
+vax_date_covid_2 = vax_dates["vax_date_covid_2"]
 
-vax_date_covid_2 = (
-    vaccinations.where(
-    vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"))
-    .where(vaccinations.date > vax_date_covid_1)  # Exclude the first date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the second date
+# Define a dictionary of preliminary date variables (Death, Vaccination) created above 
+prelim_date_variables = dict(
+    cens_date_death=death_date,
+    **vax_dates,
 )
 
-vax_date_covid_3 = (
-    vaccinations.where(
-    vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"))
-    .where(vaccinations.date > vax_date_covid_2)  # Exclude the first and second date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the third date
-)
+# COHORT DATES-----------------------------------------------------------------------------------------------------------------------------------------------
 
-vax_num_covid = (
-    vaccinations.where(
-    vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"))
-    .sort_by(vaccinations.date)
-    .count_for_patient()
-)
+# Generate index and end dates for the prevax, vax and unvax cohorts from the preliminary date and JCVI variables
+def generate_cohort_dates(
+    death_date=death_date,
+    vax_date_covid_1=vax_date_covid_1,
+    vax_date_covid_2=vax_date_covid_2,
+    vax_date_eligible=vax_date_eligible,
+):
 
-# Pfizer BioNTech Vaccination (identified by vaccination_id.product_name: 28.COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer))
-vax_date_Pfizer_1 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"))
-    .where(vaccinations.date.is_on_or_after(vax1_earliest))
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date
-)
+    ## Index dates
 
-vax_date_Pfizer_2 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"))
-    .where(vaccinations.date > vax_date_Pfizer_1)  # Exclude the first date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the second date
-)
+    index_prevax = minimum_of(date.fromisoformat(pandemic_start), date.fromisoformat(pandemic_start))
 
-vax_date_Pfizer_3 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"))
-    .where(vaccinations.date > vax_date_Pfizer_2)  # Exclude the first and second date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the third date
-)
+    index_vax = maximum_of(
+        vax_date_covid_2 + days(14),
+        date.fromisoformat(delta_date)
+    )
 
-vax_num_Pfizer = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"))
-    .sort_by(vaccinations.date)
-    .count_for_patient()
-)
+    index_unvax = maximum_of(
+        vax_date_eligible + days(84),
+        date.fromisoformat(delta_date)
+    )
 
-# Oxford AZ Vaccination (identified by vaccination_id.product_name: 49.COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca))
+    ## Deregistration dates (first deregistration on or after each index date)
 
-vax_date_AstraZeneca_1 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"))
-    .where(vaccinations.date.is_on_or_after(vax1_earliest))
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date
-)
+    registration_variables = get_registration_variables(
+        dict(prevax=index_prevax, vax=index_vax, unvax=index_unvax)
+    )
 
-vax_date_AstraZeneca_2 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"))
-    .where(vaccinations.date > vax_date_AstraZeneca_1)  # Exclude the first date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the second date
-)
+    cens_date_dereg_prevax = registration_variables["prevax"]["cens_date_dereg"]
+    cens_date_dereg_vax = registration_variables["vax"]["cens_date_dereg"]
+    cens_date_dereg_unvax = registration_variables["unvax"]["cens_date_dereg"]
 
-vax_date_AstraZeneca_3 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"))
-    .where(vaccinations.date > vax_date_AstraZeneca_2)  # Exclude the first and second date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the third date
-)
+    ## Prevax
 
-vax_num_AstraZeneca = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"))
-    .sort_by(vaccinations.date)
-    .count_for_patient()
-)
+    end_prevax_exposure = minimum_of(
+        death_date, 
+        cens_date_dereg_prevax,
+        lcd_date,
+        vax_date_covid_1, 
+        vax_date_eligible, 
+        all_eligible
+    )
 
-# Moderna Vaccination (identified by vaccination_id.product_name: 30.COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna))
+    end_prevax_outcome = minimum_of(
+        death_date, 
+        cens_date_dereg_prevax,
+        lcd_date
+    )
 
-vax_date_Moderna_1 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"))
-    .where(vaccinations.date.is_on_or_after(vax1_earliest))
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date
-)
+    ## Vax
 
-vax_date_Moderna_2 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"))
-    .where(vaccinations.date > vax_date_Moderna_1)  # Exclude the first date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the second date
-)
+    end_vax_exposure = minimum_of(
+        death_date, 
+        cens_date_dereg_vax,
+        lcd_date,
+        omicron_date
+    )
 
-vax_date_Moderna_3 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"))
-    .where(vaccinations.date > vax_date_Moderna_2)  # Exclude the first and second date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the third date
-)
+    end_vax_outcome = minimum_of(
+        death_date, 
+        cens_date_dereg_vax,
+        lcd_date
+    )
 
-vax_num_Moderna = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"))
-    .sort_by(vaccinations.date)
-    .count_for_patient()
-)
+    ## Unvax
 
-# Define a dictionary of preliminary date variables (Death, Vaccination) created above 
-prelim_date_variables = dict(
-    cens_date_death=death_date,
-    vax_date_covid_1=vax_date_covid_1,
-    vax_date_covid_2=vax_date_covid_2,
-    vax_date_covid_3=vax_date_covid_3,
-    vax_date_Pfizer_1=vax_date_Pfizer_1,
-    vax_date_Pfizer_2=vax_date_Pfizer_2,
-    vax_date_Pfizer_3=vax_date_Pfizer_3,
-    vax_date_AstraZeneca_1=vax_date_AstraZeneca_1,
-    vax_date_AstraZeneca_2=vax_date_AstraZeneca_2,
-    vax_date_AstraZeneca_3=vax_date_AstraZeneca_3,
-    vax_date_Moderna_1=vax_date_Moderna_1,
-    vax_date_Moderna_2=vax_date_Moderna_2,
-    vax_date_Moderna_3=vax_date_Moderna_3,
-)
+    end_unvax_exposure = minimum_of(
+        death_date, 
+        cens_date_dereg_unvax,
+        lcd_date, 
+        omicron_date, 
+        vax_date_covid_1
+    )
+
+    end_unvax_outcome = minimum_of(
+        death_date, 
+        cens_date_dereg_unvax,
+        lcd_date
+    )
+
+    # Define a dictionary of cohort dates created above
+    cohort_dates = dict(
+        index_prevax=index_prevax,
+        end_prevax_exposure=end_prevax_exposure,
+        end_prevax_outcome=end_prevax_outcome,
+        index_vax=index_vax,
+        end_vax_exposure=end_vax_exposure,
+        end_vax_outcome=end_vax_outcome,
+        index_unvax=index_unvax,
+        end_unvax_exposure=end_unvax_exposure,
+        end_unvax_outcome=end_unvax_outcome,
+        cens_date_dereg_prevax=cens_date_dereg_prevax,
+        cens_date_dereg_vax=cens_date_dereg_vax,
+        cens_date_dereg_unvax=cens_date_dereg_unvax,
+    )
+
+    return cohort_dates
@@ -0,0 +1,132 @@
+# Variable fingerprints for incremental re-extraction
+#
+# A variable's fingerprint is a hash of its ehrQL query (the query model tree, with sets of codes in
+# a fixed order) and of the content hashes of the codelist CSVs it uses. Comparing the fingerprints
+# of the current code with those recorded for the last full extraction gives the variables to
+# re-extract. A column read from index_dates.csv.gz takes the fingerprint of the variable of
+# dataset_definition_dates.py that writes it, so a change there also re-extracts the cohort variables
+# built from it; generate_input_{cohort}_changed extracts only those (--variables) and
+# merge_extraction.py merges them into the previous output by patient_id.
+#
+# Run from the repository root with the arguments of the cohort extraction, e.g.:
+#   python analysis/dataset_definition/variables_fingerprint.py prevax
+#   python analysis/dataset_definition/variables_fingerprint.py prevax --update -- --inline-dates
+# The first writes lib/changed_variables_prevax.json; --update records the current fingerprints in
+# lib/variable_fingerprints_prevax.json once the full extraction has been run with them.
+
+import dataclasses
+import hashlib
+import json
+import runpy
+import sys
+from argparse import ArgumentParser
+from collections.abc import Mapping
+
+from ehrql.query_model.nodes import InlinePatientTable, Node, SelectColumn
+
+from variables_manifest import dataset_variables, generate_manifest
+
+FINGERPRINTS_PATH = "lib/variable_fingerprints_{cohort}.json"
+CHANGED_PATH = "lib/changed_variables_{cohort}.json"
+
+# Canonical form of a query ---------------------------------------------------------------------
+
+def _canonical(value, digests, sources):
+    if isinstance(value, Node):
+        return node_digest(value, digests, sources)
+    if isinstance(value, Mapping):
+        # Order matters for case() conditions, so mappings keep their order
+        return "{" + ",".join(
+            f"{_canonical(k, digests, sources)}:{_canonical(v, digests, sources)}" for k, v in value.items()
+        ) + "}"
+    if isinstance(value, (frozenset, set)):
+        # Set iteration order changes between Python processes, so sets are sorted
+        return "{" + ",".join(sorted(_canonical(item, digests, sources) for item in value)) + "}"
+    if isinstance(value, (tuple, list)):
+        return "(" + ",".join(_canonical(item, digests, sources) for item in value) + ")"
+    return repr(value)
+
+# sources holds the fingerprints of the columns of index_dates.csv.gz (the variables of
+# dataset_definition_dates.py), which stand in for the columns read from it
+
+def node_digest(node, digests, sources=None):
+    sources = sources or {}
+    if node not in digests:
+        if isinstance(node, SelectColumn) and isinstance(node.source, InlinePatientTable):
+            fields = f"{node.name}={sources.get(node.name, '')}"
+        elif isinstance(node, InlinePatientTable):
+            # The rows of a table read with table_from_file are data rather than code; its columns
+            # are fingerprinted by the variables that write them (above)
+            fields = ""
+        else:
+            fields = ",".join(
+                f"{field.name}={_canonical(getattr(node, field.name), digests, sources)}"
+                for field in dataclasses.fields(node)
+            )
+        digests[node] = hashlib.sha256(f"{type(node).__name__}({fields})".encode()).hexdigest()
+    return digests[node]
+
+def variable_fingerprints(variables, sources=None):
+    digests = {}
+    manifest = {entry["name"]: entry for entry in generate_manifest(variables)}
+    fingerprints = {}
+    for name, series in variables.items():
+        codelist_hashes = sorted(codelist["sha256"] for codelist in manifest[name]["codelists"])
+        fingerprints[name] = hashlib.sha256(
+            "\n".join([node_digest(series._qm_node, digests, sources), *codelist_hashes]).encode()
+        ).hexdigest()
+    return fingerprints
+
+# Changed variables -----------------------------------------------------------------------------
+
+def compare_fingerprints(previous, current):
+    return dict(
+        changed=sorted(name for name in current if name in previous and previous[name] != current[name]),
+        added=sorted(name for name in current if name not in previous),
+        removed=sorted(name for name in previous if name not in current),
+    )
+
+def load_definition_variables(definition, user_args=()):
+    # Load a dataset definition as ehrQL would, and take the variables it adds
+    sys.argv = [definition, *user_args]
+    namespace = runpy.run_path(f"analysis/dataset_definition/{definition}")
+    return dataset_variables(namespace["dataset"])
+
+def cohort_fingerprints(cohort, user_args):
+    # The columns of index_dates.csv.gz are the variables of dataset_definition_dates.py
+    sources = variable_fingerprints(load_definition_variables("dataset_definition_dates.py"))
+    return variable_fingerprints(load_definition_variables(f"dataset_definition_{cohort}.py", user_args), sources)
+
+def main():
+    parser = ArgumentParser(description="Find the variables whose query or codelists changed since the last full extraction")
+    parser.add_argument("cohort", choices=["prevax", "vax", "unvax"])
+    parser.add_argument("--update", action="store_true", help="record the current fingerprints")
+    parser.add_argument("user_args", nargs="*", help="arguments of the cohort extraction (after --)")
+    args = parser.parse_args()
+
+    current = cohort_fingerprints(args.cohort, args.user_args)
+    fingerprints_path = FINGERPRINTS_PATH.format(cohort=args.cohort)
+
+    if args.update:
+        with open(fingerprints_path, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print(f"Recorded {len(current)} fingerprints in {fingerprints_path}")
+        return
+
+    try:
+        with open(fingerprints_path) as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        sys.exit(f"No fingerprints recorded in {fingerprints_path}; run a full extraction and --update first")
+
+    differences = compare_fingerprints(previous, current)
+    changed_path = CHANGED_PATH.format(cohort=args.cohort)
+    with open(changed_path, "w") as f:
+        json.dump(dict(variables=differences["changed"] + differences["added"], drop=differences["removed"]), f, indent=2)
+
+    for kind, names in differences.items():
+        print(f"{kind:<8} {len(names):>3}  {' '.join(names)}")
+    print(f"Wrote {changed_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Variable manifest
+#
+# With --manifest PATH, the cohort definitions write a JSON file describing every column of the
+# extraction: its ehrQL type, its role (from the variable name prefix), the tables it is built from
+# and the codelists it matches against, with the content hash of each codelist CSV. fn-preprocess.R
+# reads the column names and types from it instead of inferring them from the variable names.
+
+import dataclasses
+import hashlib
+import json
+from collections.abc import Mapping
+
+from ehrql.query_model.nodes import (
+    InlinePatientTable,
+    Node,
+    SelectPatientTable,
+    SelectTable,
+    Value,
+    get_series_type,
+)
+
+# Roles by variable name prefix, checked in order
+variable_roles = [
+    ("patient_id", "id"),
+    ("index_date", "date"),
+    ("end_date_", "date"),
+    ("exp_", "exposure"),
+    ("out_", "outcome"),
+    ("cov_", "covariate"),
+    ("strat_", "strata"),
+    ("qa_", "qa"),
+    ("inex_", "inclusion"),
+    ("sub_", "subgroup"),
+    ("cens_", "censoring"),
+    ("vax_", "vaccination"),
+    ("tmp_", "supporting"),
+]
+
+def variable_role(name):
+    for prefix, role in variable_roles:
+        if name.startswith(prefix):
+            return role
+    return "other"
+
+def file_hash(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def type_name(type_):
+    return getattr(type_, "__name__", str(type_))
+
+# Every node in a query, walking the fields of each (frozen dataclass) node
+
+def _child_nodes(value):
+    if isinstance(value, Node):
+        yield value
+    elif isinstance(value, Mapping):
+        for key, item in value.items():
+            yield from _child_nodes(key)
+            yield from _child_nodes(item)
+    elif isinstance(value, (tuple, list, frozenset, set)):
+        for item in value:
+            yield from _child_nodes(item)
+
+def query_nodes(node):
+    seen = set()
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        if not isinstance(node, Value):
+            for field in dataclasses.fields(node):
+                pending.extend(_child_nodes(getattr(node, field.name)))
+    return seen
+
+def source_tables(nodes):
+    tables = set()
+    for node in nodes:
+        if isinstance(node, (SelectTable, SelectPatientTable)):
+            tables.add(node.name)
+        elif isinstance(node, InlinePatientTable):
+            tables.add("table_from_file")
+    return sorted(tables)
+
+def _codes(values):
+    return frozenset(str(getattr(code, "value", code)) for code in values)
+
+# Codelists matched by the sets of codes in a query. A set of codes that equals a codelist is matched
+# to it; otherwise it is matched to every codelist it is part of (e.g. one category of ethnicity_snomed)
+# or that is part of it (e.g. the union of the outcome codelists used to pre-filter clinical_events)
+
+def matched_codelists(nodes, codelist_codes, cache):
+    matched = set()
+    for node in nodes:
+        if not (isinstance(node, Value) and isinstance(node.value, frozenset) and node.value):
+            continue
+        if node not in cache:
+            codes = _codes(node.value)
+            exact = {name for name, codelist in codelist_codes.items() if codelist == codes}
+            cache[node] = exact or {
+                name for name, codelist in codelist_codes.items()
+                if codes <= codelist or codelist <= codes
+            }
+        matched |= cache[node]
+    return sorted(matched)
+
+def generate_manifest(variables):
+    from codelists import loaded_codelists
+
+    codelists = loaded_codelists()
+    codelist_codes = {name: _codes(codelist) for name, (_, codelist) in codelists.items()}
+    codelist_hashes = {}
+    matches = {}
+
+    def codelist_entry(name):
+        filename = codelists[name][0]
+        if filename not in codelist_hashes:
+            codelist_hashes[filename] = file_hash(filename)
+        return dict(name=name, file=filename, sha256=codelist_hashes[filename])
+
+    manifest = [dict(name="patient_id", type="int", role="id", tables=[], codelists=[])]
+    for name, series in variables.items():
+        nodes = query_nodes(series._qm_node)
+        manifest.append(
+            dict(
+                name=name,
+                type=type_name(get_series_type(series._qm_node)),
+                role=variable_role(name),
+                tables=source_tables(nodes),
+                codelists=[codelist_entry(codelist) for codelist in matched_codelists(nodes, codelist_codes, matches)],
+            )
+        )
+    return manifest
+
+# The dataset's variables, in the order they were added. ehrQL has no public API for them, so this is
+# the only place that reads its private Dataset._variables (the manifest, the variable fingerprints
+# and the benchmark wrapper all go through it)
+
+def dataset_variables(dataset):
+    variables = getattr(dataset, "_variables", None)
+    if variables is None:
+        raise RuntimeError(
+            "This version of ehrQL does not keep the dataset's variables in Dataset._variables; "
+            "update dataset_variables() in variables_manifest.py"
+        )
+    return variables
+
+def write_manifest(dataset, path):
+    with open(path, "w") as f:
+        json.dump(dict(variables=generate_manifest(dataset_variables(dataset))), f, indent=2)
@@ -0,0 +1,110 @@
+# Variables required by the active analyses
+#
+# With --prune-variables, the cohort definitions only add the columns of generate_variables that
+# the analyses in lib/active_analyses.json (written alongside lib/active_analyses.rds by
+# active_analyses.R) or the cleaning, table and Venn scripts use. Other variables, e.g.
+# cov_bin_migraine or the dementia subtypes when only out_date_dem_any is analysed, are dropped.
+
+import json
+
+ACTIVE_ANALYSES_PATH = "lib/active_analyses.json"
+
+# Variables whose prefix is always kept: fn-inex.R, fn-qa.R, fn-modify_dummy.R, table1.R and
+# table2.R use all of them, whatever the analyses
+required_prefixes = ["inex_", "qa_", "sub_", "strat_", "cens_", "exp_", "cov_cat_", "cov_num_"]
+
+# Variables that prepare_model_input() (fn-prepare_model_input.R) keeps for every model input
+required_always = [
+    "cov_bin_cis",
+    "cov_bin_parkrisk",
+    "cov_bin_park",
+    "cov_bin_highvascrisk",
+]
+
+# Variables needed to define each subgroup, by the subgroup name used in the analysis column
+# (e.g. sub_covidhospital_TRUE_noday0 -> covidhospital)
+subgroup_variables = {
+    "covidhospital": ["sub_cat_covidhospital"],
+    "covidhistory": ["sub_bin_covidhistory"],
+    "sex": ["cov_cat_sex"],
+    "age": ["cov_num_age"],
+    "ethnicity": ["cov_cat_ethnicity"],
+    "cis": ["cov_bin_cis"],
+    "park": ["cov_bin_park"],
+    "parkrisk": ["cov_bin_parkrisk"],
+    "highvascrisk": ["cov_bin_highvascrisk"],
+}
+
+# Variables that other variables depend on in the cleaning scripts, e.g. the COVID-19 hospitalisation
+# subgroup is only defined for the exposed
+variable_dependencies = {
+    "sub_cat_covidhospital": ["exp_date_covid"],
+    "sub_bin_covidhistory": ["exp_date_covid"],
+}
+
+def read_active_analyses(path=ACTIVE_ANALYSES_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+# History covariate used to exclude patients with the outcome before index, as in
+# prepare_model_input(): dementia outcomes use any dementia, and Parkinson's outcomes also exclude it
+
+def outcome_history_variables(outcome):
+    outcome = outcome.removeprefix("out_date_")
+    if "dem" in outcome:
+        history = ["cov_bin_dem_any"]
+    else:
+        history = [f"cov_bin_{outcome}"]
+    if "park" in outcome:
+        history.append("cov_bin_dem_any")
+    return history
+
+def analysis_variables(analysis, variable_names):
+    outcome = analysis["outcome"]
+
+    required = [
+        analysis["exposure"],
+        outcome,
+        analysis["strata"],
+        analysis["covariate_sex"],
+        analysis["covariate_age"],
+        *analysis["covariate_other"].split(";"),
+        *outcome_history_variables(outcome),
+    ]
+
+    # Source-specific outcome dates for the Venn diagrams (e.g. tmp_out_date_ms_gp)
+    required += [name for name in variable_names if name.startswith(f"tmp_{outcome}_")]
+
+    if analysis["analysis"].startswith("sub_"):
+        subgroup = analysis["analysis"].split("_")[1]
+        required += subgroup_variables[subgroup]
+
+    return required
+
+# Names of the variables in variable_names needed by the cohort's active analyses, including the
+# variables they depend on
+
+def required_variables(cohort, variable_names, analyses=None):
+    if analyses is None:
+        analyses = read_active_analyses()
+
+    required = set(required_always)
+    for analysis in analyses:
+        if analysis["cohort"] == cohort:
+            required.update(analysis_variables(analysis, variable_names))
+
+    pending = list(required)
+    while pending:
+        for dependency in variable_dependencies.get(pending.pop(), []):
+            if dependency not in required:
+                required.add(dependency)
+                pending.append(dependency)
+
+    return {
+        name for name in variable_names
+        if name in required or name.startswith(tuple(required_prefixes))
+    }
+
+def prune_variables(variables, cohort, analyses=None):
+    required = required_variables(cohort, variables.keys(), analyses)
+    return {name: value for name, value in variables.items() if name in required}
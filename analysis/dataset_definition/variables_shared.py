@@ -0,0 +1,82 @@
+from ehrql import (
+    case,
+    claim_permissions,
+    when,
+)
+# Bring table definitions from the TPP backend
+from ehrql.tables.tpp import (
+    patients,
+    appointments,
+    occupation_on_covid_vaccine_record,
+    vaccinations,
+)
+
+# Call functions from variable_helper_functions
+from variable_helper_functions import (
+    get_ethnicity_sus,
+)
+
+# Claim permissions to allow dataset definition to import tables in dummy data
+claim_permissions("appointments", "occupation_on_covid_vaccine_record")
+
+# COVID-19 vaccination groups and the number of doses extracted for each. The dates stage
+# (variables_dates.py) writes one column per group and dose, vax_date_{group}_{dose}, to
+# index_dates.csv.gz, and dataset_definition_cohorts.py reads the same columns back
+vax_doses = 3
+
+vax_groups = dict(
+    # COVID-19 Vaccination (identified by target diseases of the vaccination)
+    covid=vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"),
+    # Pfizer BioNTech Vaccination (identified by vaccination_id.product_name: 28.COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer))
+    Pfizer=(vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"),
+    # Oxford AZ Vaccination (identified by vaccination_id.product_name: 49.COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca))
+    AstraZeneca=(vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"),
+    # Moderna Vaccination (identified by vaccination_id.product_name: 30.COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna))
+    Moderna=(vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"),
+)
+
+# Variables that do not depend on the cohort index date. They are extracted once, alongside the
+# cohort dates in dataset_definition_dates.py, and joined onto each cohort from index_dates.csv.gz
+
+def generate_shared_variables():
+
+    ### Year of birth
+    qa_num_birth_year = patients.date_of_birth.year
+
+    ### Sex
+    cov_cat_sex = patients.sex
+
+    ### Ethnicity recorded in SUS (used when there is no primary care ethnicity code before index)
+    tmp_cov_cat_ethnicity_sus = get_ethnicity_sus(grouping=6)
+
+    ### Consultation rate in 2019
+    tmp_cov_num_consrate2019 = appointments.where(
+        appointments.status.is_in([
+            "Arrived",
+            "In Progress",
+            "Finished",
+            "Visit",
+            "Waiting",
+            "Patient Walked Out",
+            ]) & appointments.start_date.is_on_or_between("2019-01-01", "2019-12-31")
+            ).count_for_patient()
+
+    cov_num_consrate2019 = case(
+        when(tmp_cov_num_consrate2019 <= 365).then(tmp_cov_num_consrate2019),
+        otherwise=365,
+    )
+
+    ### Healthcare worker
+    cov_bin_hcworker = occupation_on_covid_vaccine_record.where(
+        (occupation_on_covid_vaccine_record.is_healthcare_worker == True)
+    ).exists_for_patient()
+
+    shared_variables = dict(
+        qa_num_birth_year         = qa_num_birth_year,
+        cov_cat_sex               = cov_cat_sex,
+        tmp_cov_cat_ethnicity_sus = tmp_cov_cat_ethnicity_sus,
+        cov_num_consrate2019      = cov_num_consrate2019,
+        cov_bin_hcworker          = cov_bin_hcworker,
+    )
+
+    return shared_variables